@@ -1,14 +1,42 @@
 from __future__ import annotations
-from collections import defaultdict
+from array import array
+from bisect import bisect_left
+from collections import defaultdict, deque
+from collections.abc import Callable, Iterator
 from enum import Enum, auto
-from math import ceil
+from itertools import accumulate
+from multiprocessing import resource_tracker, shared_memory
+from typing import BinaryIO
+from math import ceil, sqrt
 from sys import argv, exit
-from time import time, strftime
+from time import sleep, time, strftime
 import argparse
+import contextlib
+import gzip
+import hashlib
+import heapq
+import io
+import json
 import multiprocessing
+import multiprocessing.managers
 import multiprocessing.pool
+import os
 import pathlib
+import pickle
+import queue
+import random
+import shutil
+import socket
+import sys
+import tempfile
 import textwrap
+import threading
+import traceback
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
 __version__ = 0.12
 
@@ -24,6 +52,11 @@ Header = list[bytes]
 PatientCodes = dict[bytes, bytes]
 SummaryData = dict[bytes, int]
 PoolType = multiprocessing.pool.Pool
+Projection = list[int] | None  # indices of the columns to keep, None keeps all of them
+Estimate = tuple[float, float]  # estimated value, half width of the 95% confidence interval
+CompactData = tuple[bytes | tuple[str, int], array, array]  # lines (or shared memory name, size), keys, offsets
+Zones = list[tuple[int, int, int, int]]  # start byte, end byte, min report key, max report key
+Chunking = tuple[int, int]  # at least this many chunks per file, at most this many bytes per chunk (0 for no limit)
 
 SUCCESS = 0
 FAILURE = 1
@@ -31,6 +64,38 @@ KILO = 1024
 MEGA = 1024 * KILO
 GIGA = 1024 * MEGA
 BUF_SIZE = 10 * MEGA
+CACHE_DATA = "maude.txt"
+GZIP_LEVEL = 6
+CACHE_SUMMARY = "summary.pickle"
+NP_BLOCK_SIZE = 64 * MEGA
+ZONE_BLOCK_SIZE = 16 * MEGA
+HAS_FADVISE = hasattr(os, "posix_fadvise")  # NOTE: not available on Windows.
+SAMPLE_BLOCK_SIZE = 4 * MEGA
+DEFAULT_PORT = 50000
+AUTHKEY_ENV = "MAUDER_AUTHKEY"
+HEARTBEAT_INTERVAL = 5  # seconds
+HEARTBEAT_TIMEOUT = 30  # seconds
+CLAIM_TIMEOUT = 5  # seconds
+MAX_ATTEMPTS = 3
+RUN_BLOCK_SIZE = 10000  # records
+SPILL_OVERHEAD = 4  # rough size of the parsed records in memory vs. the lines they came from
+KEY_OVERHEAD = 80  # rough size of a report key in a set, in bytes
+PROFILE_FILE = "mauder-profile.json"
+AUTOTUNE_SAMPLE_SIZE = 256 * MEGA  # per file, at least
+AUTOTUNE_CHUNK_SIZES = [4 * MEGA, 16 * MEGA, 64 * MEGA]
+AUTOTUNE_WAVES = 2  # chunks per process in the sample, at least
+AUTOTUNE_KEY_FRACTION = 0.05  # share of the reports searched for, about a big product code query
+# NOTE: these are the only functions a coordinator is allowed to ask a worker to run (checked on both ends).
+REMOTE_TASKS = {
+    "parse_device_chunk",
+    "parse_general_chunk",
+    "parse_general_chunk_numpy",
+    "parse_general_chunk_compact",
+    "parse_patient_chunk",
+    "parse_patient_chunk_numpy",
+    "zone_map_chunk",
+    "compress_block",
+}
 
 
 class PtFileType(Enum):
@@ -38,17 +103,46 @@ class PtFileType(Enum):
     DEC = auto()
 
 
+class Backend(Enum):
+    PROCESSES = auto()
+    THREADS = auto()
+
+
+class Engine(Enum):
+    PYTHON = auto()
+    NUMPY = auto()
+
+
+class ResultFormat(Enum):
+    OBJECTS = auto()
+    COMPACT = auto()
+    SHARED = auto()
+
+
 def main(args: list) -> int:
+    if args and args[0] == "worker":
+        return worker_main(args[1:])
     arguments = parse_args(args)
     if arguments.more:
         print_long_help()
         parse_args(["-h"])
         return SUCCESS  # NOTE: not necessary -h will exit, for clarity only.
-    if not len(args) or arguments.procs < 1:
+    here = pathlib.Path(__file__).parent
+    backend = get_backend(arguments.backend)
+    engine = Engine.NUMPY if arguments.engine == "numpy" else Engine.PYTHON
+    results = ResultFormat[arguments.results.upper()]
+    profile = load_profile(here / PROFILE_FILE, backend, engine, results)
+    if arguments.procs is None:
+        arguments.procs = profile.get("procs") or physical_cores()
+    if arguments.chunk_size is None:
+        arguments.chunk_size = profile.get("chunk_size", 0) / MEGA
+    if not len(args) or arguments.procs < 1 or arguments.chunk_size < 0:
         parse_args(["-h"])
         return SUCCESS  # NOTE: not necessary -h will exit, for clarity only.
+    if engine == Engine.NUMPY and np is None:
+        print("The numpy engine requires numpy to be installed.")
+        return FAILURE
 
-    here = pathlib.Path(__file__).parent
     data_dir = here / "mdr-data-files"
     device_dir = data_dir / "device"
     foitext_dir = data_dir / "foitext"
@@ -61,6 +155,14 @@ def main(args: list) -> int:
     if not output_dir.exists():
         output_dir.mkdir(parents=True)
         print(f"creating output directory: {output_dir.resolve()}")
+    cache_dir = pathlib.Path(arguments.cache_dir)
+    if not cache_dir.is_absolute():
+        cache_dir = here / cache_dir
+    if arguments.autotune:
+        paths = [device_dir, foitext_dir, patient_problem_dir, mdrfoi_dir]
+        return autotune(paths, backend, engine, results, here / PROFILE_FILE)
+    # NOTE: a cache hit would make the speed test meaningless.
+    use_cache = not arguments.no_cache and not arguments.test and not arguments.estimate
 
     start: float = 0
     parse_end: float = 0
@@ -71,36 +173,168 @@ def main(args: list) -> int:
         if arguments.test:
             start = time()
         product_codes = {bytes(arg, encoding="utf-8") for arg in arguments.codes}
-        n_chunks = arguments.procs
-        pool = multiprocessing.Pool(n_chunks)
-        maude_data, header, maude_keys = parse_device_files(device_dir, product_codes, n_chunks, pool)
-        maude_data, header = parse_foitext(foitext_dir, maude_data, header, maude_keys, n_chunks, pool)
-        patient_codes = parse_patient_codes(patient_codes_dir)
-        maude_data, header = parse_patient_problems(
-            patient_problem_dir, maude_data, header, maude_keys, patient_codes, n_chunks, pool
-        )
-        maude_data, header = parse_mdrfoi(mdrfoi_dir, maude_data, header, maude_keys, n_chunks, pool)
-        pool.close()
-        if arguments.test:
-            parse_end = time()
-        if len(maude_keys) and (err := length_check(maude_data, header)):
-            print("Data parsing error.")
-            print("The length of the header and the number columns do not match.")
-            print("Report this error to https://www.github.com/jadczak/mauder")
-            return err
+        columns = {bytes(arg, encoding="utf-8") for arg in arguments.columns}
+        data_dirs = [device_dir, foitext_dir, patient_problem_dir, mdrfoi_dir]
+        chunking = (arguments.procs, int(arguments.chunk_size * MEGA))
+        if unknown_columns := check_columns(data_dirs, columns):
+            print("Unknown columns requested:")
+            for column in sorted(unknown_columns):
+                print(f"\t{column.decode('utf-8')}")
+            return FAILURE
         codes = "-".join([c for c in arguments.codes])
-        now = strftime("%Y%m%d%H%M%S")
-        maude_file = output_dir / rf"{now}-{codes}.txt"
-        write_maude_data_bytes(maude_file, maude_data, header)
+        compress = arguments.compress == "gzip"
+        extension = "txt.gz" if compress else "txt"
+        cache_entry = None
+        if use_cache:
+            fingerprint = dataset_fingerprint(data_dirs + [patient_codes_dir])
+            options = {"version": __version__, "columns": sorted(columns), "compress": compress}
+            cache_entry = get_cache_entry(cache_dir, product_codes, options, fingerprint)
+            now = strftime("%Y%m%d%H%M%S")
+            maude_file = output_dir / rf"{now}-{codes}.{extension}"
+            if cached := load_cached_result(cache_entry, maude_file):
+                n_reports, n_problems, summary_data = cached
+                summary_file = output_dir / rf"{now}-{codes}-summary.txt"
+                write_summary_data(summary_file, n_reports, n_problems, summary_data, product_codes, now)
+                return SUCCESS
+        prefetch = arguments.prefetch
+        if arguments.coordinator and not arguments.authkey:
+            # NOTE: the coordinator and workers trade pickles, so anyone with the key can run code on them.
+            print(f"--coordinator needs a secret --authkey (or {AUTHKEY_ENV} set) shared with the workers.")
+            return FAILURE
+        if arguments.coordinator and results == ResultFormat.SHARED:
+            print("shared memory results can't be used with remote workers, using compact results")
+            results = ResultFormat.COMPACT
+        parallel_write = arguments.parallel_write
+        if parallel_write and (backend != Backend.THREADS or arguments.coordinator) and not compress:
+            # NOTE: a process pool would need every record pickled over to it, so there's nothing to gain.
+            print("-w only helps with -b threads, writing the output from this process")
+            parallel_write = False
+        if arguments.coordinator:
+            pool = RemotePool(parse_address(arguments.coordinator), arguments.authkey.encode("utf-8"), data_dir)
+        else:
+            pool = make_pool(backend, arguments.procs)
+        if arguments.estimate:
+            patient_codes = parse_patient_codes(patient_codes_dir)
+            reports, problems, problem_estimates, sampled_fraction = estimate_data(
+                device_dir,
+                patient_problem_dir,
+                product_codes,
+                patient_codes,
+                arguments.estimate,
+                chunking,
+                pool,
+                engine,
+                prefetch,
+            )
+            pool.close()
+            print_estimate(reports, problems, problem_estimates, product_codes, sampled_fraction)
+            return SUCCESS
+        spill = None
+        try:
+            if arguments.max_memory:
+                max_memory = arguments.max_memory * GIGA
+                total_size = sum([file.stat().st_size for path in data_dirs for file in path.iterdir()])
+                # NOTE: only one batch of chunk results is held at a time, so size the chunks to fit the budget.
+                max_chunk_size = max(int(max_memory / (SPILL_OVERHEAD * arguments.procs)), 1)
+                chunking = (arguments.procs, min(chunking[1] or max_chunk_size, max_chunk_size))
+                n_partitions = max(ceil(total_size * SPILL_OVERHEAD / max_memory), 1)
+                spill = SpillStore(output_dir, n_partitions)
+                pool = BatchedPool(pool, arguments.procs)
+            maude_data, header, maude_keys = parse_device_files(
+                device_dir, product_codes, chunking, pool, engine, columns, prefetch, results, spill
+            )
+            if spill:
+                # NOTE: the report keys get pickled into every chunk task from here on, so each worker
+                #       process holds its own copy on top of this one.  Take them out of the budget.
+                copies = arguments.procs + 1 if backend == Backend.PROCESSES and not arguments.coordinator else 1
+                key_memory = len(maude_keys) * KEY_OVERHEAD * copies
+                if key_memory < max_memory:
+                    max_chunk_size = max(int((max_memory - key_memory) / (SPILL_OVERHEAD * arguments.procs)), 1)
+                    chunking = (arguments.procs, min(chunking[1], max_chunk_size))
+                else:
+                    print(f"the report keys alone need about {key_memory / GIGA:.3f} GB, more than --max-memory")
+                    print("use a smaller -p or -b threads to get under it")
+            zone_dir = data_dir / "zonemaps" if arguments.zone_maps else None
+            maude_data, header = parse_foitext(
+                foitext_dir,
+                maude_data,
+                header,
+                maude_keys,
+                chunking,
+                pool,
+                engine,
+                zone_dir,
+                columns,
+                prefetch,
+                results,
+                spill,
+            )
+            patient_codes = parse_patient_codes(patient_codes_dir)
+            maude_data, header = parse_patient_problems(
+                patient_problem_dir,
+                maude_data,
+                header,
+                maude_keys,
+                patient_codes,
+                chunking,
+                pool,
+                engine,
+                columns,
+                prefetch,
+                spill,
+            )
+            maude_data, header = parse_mdrfoi(
+                mdrfoi_dir,
+                maude_data,
+                header,
+                maude_keys,
+                chunking,
+                pool,
+                engine,
+                zone_dir,
+                columns,
+                prefetch,
+                results,
+                spill,
+            )
+            if arguments.test:
+                parse_end = time()
+            if spill:
+                # NOTE: the join doesn't need the keys, so don't hold onto them on top of a partition.
+                maude_keys.clear()
+                err = join_spilled_data(spill, header)
+            else:
+                err = length_check(maude_data, header) if len(maude_keys) else SUCCESS
+            if err:
+                print("Data parsing error.")
+                print("The length of the header and the number columns do not match.")
+                print("Report this error to https://www.github.com/jadczak/mauder")
+                return err
+            now = strftime("%Y%m%d%H%M%S")
+            maude_file = output_dir / rf"{now}-{codes}.{extension}"
+            if spill:
+                n_reports, n_problems, summary_data = write_spilled_data(maude_file, spill, header, compress)
+            elif parallel_write or compress:
+                write_maude_data_parallel(maude_file, maude_data, header, arguments.procs, pool, compress)
+            else:
+                write_maude_data_bytes(maude_file, maude_data, header)
+        finally:
+            # NOTE: an exception part way through would otherwise leave spill files in the output folder.
+            pool.close()
+            if spill:
+                spill.close()
         if arguments.test:
             maude_write_end = time()
-        n_reports, n_problems, summary_data = summarize_data(header, maude_data)
+        if not spill:
+            n_reports, n_problems, summary_data = summarize_data(header, maude_data)
         if arguments.test:
             summarize_end = time()
         summary_file = output_dir / rf"{now}-{codes}-summary.txt"
         write_summary_data(summary_file, n_reports, n_problems, summary_data, product_codes, now)
         if arguments.test:
             summary_write_end = time()
+        if cache_entry:
+            store_cached_result(cache_entry, maude_file, n_reports, n_problems, summary_data, arguments.cache_size)
     else:
         print("No product codes provided.")
         return FAILURE
@@ -124,6 +358,12 @@ def main(args: list) -> int:
         if parsing_time:
             print(f"{'File Parsing':20}{parsing_time:<20.3f}{parsing_throughput:<20.3f}{parsing_efficiency:<20.2%}")
             print(f"{'Multiprocessing pool size':40}{arguments.procs}")
+            if chunking[1]:
+                print(f"{'Max chunk size':40}{chunking[1] / MEGA:g} MB")
+            else:
+                print(f"{'Chunks per file':40}{chunking[0]}")
+            print(f"{'Pool backend':40}{backend.name.lower()}")
+            print(f"{'Parsing engine':40}{engine.name.lower()}")
             print(f"{'Time to write maude file':40}{maude_writing_time:.3f}s")
             print(f"{'Time to summarize data':40}{summarize_time:.3f}s")
             print(f"{'Time to write summary':40}{summary_write_time:.3f}s")
@@ -135,6 +375,294 @@ def main(args: list) -> int:
     return SUCCESS
 
 
+def get_backend(name: str) -> Backend:
+    """
+    Picks the pool backend.  Threads only make sense on a free-threaded (no-GIL) build of
+    CPython where they run the chunk parsers in parallel and hand back their results without
+    pickling them across process boundaries.  Everywhere else the process pool wins.
+    """
+    if name == "threads":
+        return Backend.THREADS
+    elif name == "processes":
+        return Backend.PROCESSES
+    # NOTE: sys._is_gil_enabled() only exists on 3.13+, anything older always has a GIL.
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    if is_gil_enabled is not None and not is_gil_enabled():
+        return Backend.THREADS
+    return Backend.PROCESSES
+
+
+def make_pool(backend: Backend, size: int) -> PoolType:
+    """
+    ThreadPool shares the Pool interface, so the parsing stages don't care which one they get.
+    """
+    if backend == Backend.THREADS:
+        return multiprocessing.pool.ThreadPool(size)
+    return multiprocessing.Pool(size)
+
+
+class TaskBoard:
+    """
+    Lives in the coordinator and is shared with the remote workers through a BoardManager.
+    Hands out chunk tasks, collects their results, and takes tasks back from any worker that
+    stops checking in so that another worker can pick them up.
+    """
+
+    def __init__(self) -> None:
+        self._cond = threading.Condition()
+        self._tasks: dict[int, tuple[str, list]] = {}
+        self._pending: deque[int] = deque()
+        self._leases: dict[int, str] = {}  # task id -> worker id
+        self._attempts: dict[int, int] = defaultdict(int)
+        self._results: dict[int, object] = {}
+        self._errors: dict[int, str] = {}
+        self._seen: dict[str, float] = {}  # worker id -> last time we heard from it
+        self._next_id = 0
+        self._closed = False
+
+    def submit(self, name: str, args: list) -> int:
+        with self._cond:
+            task_id = self._next_id
+            self._next_id += 1
+            self._tasks[task_id] = (name, args)
+            self._pending.append(task_id)
+            self._cond.notify_all()
+            return task_id
+
+    def collect(self, task_ids: list[int]) -> list:
+        """
+        Blocks until every task has a result and returns them in the order requested.
+        """
+        with self._cond:
+            while missing := [task_id for task_id in task_ids if task_id not in self._results]:
+                for task_id in missing:
+                    if task_id in self._errors:
+                        raise RuntimeError(f"remote task failed {MAX_ATTEMPTS} times:\n{self._errors[task_id]}")
+                self._reap()
+                self._cond.wait(1.0)
+            results = [self._results.pop(task_id) for task_id in task_ids]
+            for task_id in task_ids:
+                del self._tasks[task_id]
+                del self._attempts[task_id]
+            return results
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def is_closed(self) -> bool:
+        return self._closed
+
+    def claim(self, worker_id: str, timeout: float) -> tuple[int, str, list] | None:
+        """
+        Worker side.  Returns None if there wasn't anything to do before the timeout.
+        """
+        with self._cond:
+            self._seen[worker_id] = time()
+            deadline = time() + timeout
+            while True:
+                while self._pending:
+                    task_id = self._pending.popleft()
+                    if task_id not in self._tasks or task_id in self._results:
+                        continue  # finished by a worker we had given up on.
+                    self._leases[task_id] = worker_id
+                    self._attempts[task_id] += 1
+                    name, args = self._tasks[task_id]
+                    return task_id, name, args
+                remaining = deadline - time()
+                if self._closed or remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def complete(self, worker_id: str, task_id: int, result: object) -> None:
+        with self._cond:
+            self._seen[worker_id] = time()
+            self._leases.pop(task_id, None)
+            if task_id in self._tasks and task_id not in self._results:
+                self._results[task_id] = result
+            self._cond.notify_all()
+
+    def fail(self, worker_id: str, task_id: int, error: str) -> None:
+        with self._cond:
+            self._seen[worker_id] = time()
+            self._leases.pop(task_id, None)
+            if task_id not in self._tasks or task_id in self._results:
+                return
+            print(f"task failed on worker {worker_id}")
+            if self._attempts[task_id] >= MAX_ATTEMPTS:
+                self._errors[task_id] = error
+            else:
+                self._pending.append(task_id)
+            self._cond.notify_all()
+
+    def heartbeat(self, worker_id: str) -> None:
+        with self._cond:
+            self._seen[worker_id] = time()
+
+    def _reap(self) -> None:
+        """
+        Puts the tasks of any worker that has gone quiet back in the queue.
+        """
+        now = time()
+        for worker_id, last_seen in list(self._seen.items()):
+            if now - last_seen > HEARTBEAT_TIMEOUT:
+                del self._seen[worker_id]
+                lost = [task_id for task_id, owner in self._leases.items() if owner == worker_id]
+                print(f"lost worker {worker_id}, reassigning {len(lost)} tasks")
+                for task_id in lost:
+                    del self._leases[task_id]
+                    self._pending.appendleft(task_id)
+                self._cond.notify_all()
+
+
+class BoardManager(multiprocessing.managers.BaseManager):
+    pass
+
+
+class RemotePool:
+    """
+    Stand in for the multiprocessing pool that farms the chunk tasks out to `mauder.py worker`
+    processes on other machines.  Only starmap() and close() are needed by the parsing stages,
+    imap() is there for compressing the output.
+    Data file paths are sent relative to mdr-data-files so each worker reads its own copy.
+    """
+
+    def __init__(self, address: tuple[str, int], authkey: bytes, data_dir: pathlib.Path) -> None:
+        self.data_dir = data_dir
+        self.board = TaskBoard()
+        BoardManager.register("get_board", callable=lambda: self.board)
+        server = BoardManager(address=address, authkey=authkey).get_server()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        print(f"coordinator listening on {address[0]}:{address[1]}, waiting for workers")
+
+    def starmap(self, func: Callable, iterable: list) -> list:
+        if func.__name__ not in REMOTE_TASKS:
+            raise ValueError(f"{func.__name__} can't be run remotely")
+        task_ids = []
+        for args in iterable:
+            args = [self.relative_path(arg) for arg in args]
+            task_ids.append(self.board.submit(func.__name__, args))
+        return self.board.collect(task_ids)
+
+    def imap(self, func: Callable, iterable: Iterator) -> Iterator:
+        return iter(self.starmap(func, [[arg] for arg in iterable]))
+
+    def close(self) -> None:
+        self.board.close()
+
+    def relative_path(self, arg: object) -> object:
+        if isinstance(arg, pathlib.Path) and arg.is_relative_to(self.data_dir):
+            return pathlib.PurePosixPath(*arg.relative_to(self.data_dir).parts)
+        return arg
+
+
+class BatchedPool:
+    """
+    Stand in for the pool used with --max-memory.  starmap() hands the tasks to the real pool
+    a batch at a time and yields the results as they come back, so the parsing stages only
+    ever hold one batch of chunk results instead of the results for the whole file.
+    """
+
+    def __init__(self, pool: PoolType, batch_size: int) -> None:
+        self.pool = pool
+        self.batch_size = batch_size
+
+    def starmap(self, func: Callable, iterable: list) -> Iterator:
+        for batch in self.starmap_batches(func, iterable):
+            yield from batch
+
+    def starmap_batches(self, func: Callable, iterable: list) -> Iterator[list]:
+        tasks = list(iterable)
+        for i in range(0, len(tasks), self.batch_size):
+            yield self.pool.starmap(func, tasks[i : i + self.batch_size])
+
+    def close(self) -> None:
+        self.pool.close()
+
+
+def parse_address(address: str) -> tuple[str, int]:
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+def worker_main(args: list[str]) -> int:
+    """
+    Connects to a coordinator (mauder.py --coordinator) and runs the chunk tasks it hands out
+    against this machine's copy of mdr-data-files until the coordinator is done.
+    """
+    arguments = parse_worker_args(args)
+    if not arguments.authkey:
+        print(f"worker needs the coordinator's --authkey (or {AUTHKEY_ENV} set).")
+        return FAILURE
+    data_dir = pathlib.Path(arguments.data_dir)
+    if not data_dir.is_absolute():
+        data_dir = pathlib.Path(__file__).parent / data_dir
+    address = parse_address(arguments.connect)
+    BoardManager.register("get_board")
+    manager = BoardManager(address=address, authkey=arguments.authkey.encode("utf-8"))
+    deadline = time() + arguments.wait
+    while True:
+        try:
+            manager.connect()
+            break
+        except ConnectionRefusedError:
+            if time() > deadline:
+                print(f"could not connect to coordinator at {arguments.connect}")
+                return FAILURE
+            sleep(1)
+    board = manager.get_board()
+    worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    print(f"worker {worker_id} connected to {arguments.connect}")
+
+    if arguments.procs is None:
+        arguments.procs = physical_cores()
+    pool = multiprocessing.Pool(arguments.procs)
+    done = threading.Event()
+
+    def heartbeat() -> None:
+        while not done.wait(HEARTBEAT_INTERVAL):
+            try:
+                board.heartbeat(worker_id)
+            except (OSError, EOFError):
+                done.set()
+
+    def run_tasks() -> None:
+        while not done.is_set():
+            try:
+                task = board.claim(worker_id, CLAIM_TIMEOUT)
+                if task is None:
+                    if board.is_closed():
+                        done.set()
+                    continue
+                task_id, name, task_args = task
+                if name not in REMOTE_TASKS:
+                    board.fail(worker_id, task_id, f"{name} can't be run remotely")
+                    continue
+                task_args = [
+                    data_dir.joinpath(*arg.parts) if isinstance(arg, pathlib.PurePath) else arg for arg in task_args
+                ]
+                try:
+                    result = pool.apply(globals()[name], task_args)
+                except Exception:
+                    board.fail(worker_id, task_id, traceback.format_exc())
+                    continue
+                board.complete(worker_id, task_id, result)
+            except (OSError, EOFError):
+                done.set()  # coordinator went away.
+
+    threads = [threading.Thread(target=heartbeat, daemon=True)]
+    threads += [threading.Thread(target=run_tasks) for _ in range(arguments.procs)]
+    for thread in threads:
+        thread.start()
+    for thread in threads[1:]:
+        thread.join()
+    done.set()
+    pool.close()
+    print(f"worker {worker_id} finished")
+    return SUCCESS
+
+
 def write_maude_data_bytes(file: pathlib.Path, maude_data: MaudeData, header: Header) -> None:
     """
     dump maude data to file
@@ -149,6 +677,48 @@ def write_maude_data_bytes(file: pathlib.Path, maude_data: MaudeData, header: He
             f.write(b"\n")
 
 
+def serialize_block(records: list[list[bytes]], compress: bool) -> bytes:
+    """
+    Turns a block of records into the bytes that end up in the maude file.  When compressing,
+    each block is its own gzip member.  A gzip file is allowed to be a bunch of members back to
+    back, so the blocks can be compressed independently and still make a valid file.
+    """
+    block = b"".join([b"\t".join(record) + b"\n" for record in records])
+    if compress:
+        return compress_block(block)
+    return block
+
+
+def compress_block(block: bytes) -> bytes:
+    return gzip.compress(block, compresslevel=GZIP_LEVEL)
+
+
+def write_maude_data_parallel(
+    file: pathlib.Path, maude_data: MaudeData, header: Header, n_blocks: int, pool: PoolType, compress: bool
+) -> None:
+    """
+    Same output as write_maude_data_bytes() (optionally gzipped) but the sorted keys are split
+    into ranges and the blocks are built in the pool.  Only a thread pool can get at maude_data
+    without pickling every record over to it, which costs a lot more than the join it saves.
+    So with processes the blocks are joined here and only compressing them is farmed out.
+    The blocks are written in order as they come back.
+    """
+    print("writing output to disk")
+    keys = sorted(maude_data)
+    block_size = max(ceil(len(keys) / n_blocks), 1)
+    record_blocks = ([maude_data[key] for key in keys[i : i + block_size]] for i in range(0, len(keys), block_size))
+    if isinstance(pool, multiprocessing.pool.ThreadPool):
+        blocks = pool.imap(lambda records: serialize_block(records, compress), record_blocks)
+    elif compress:
+        blocks = pool.imap(compress_block, (serialize_block(records, False) for records in record_blocks))
+    else:
+        blocks = (serialize_block(records, False) for records in record_blocks)
+    with open(file, "wb") as f:
+        f.write(serialize_block([header], compress))
+        for block in blocks:
+            f.write(block)
+
+
 def length_check(maude_data: MaudeData, header: Header) -> int:
     """
     Sanity check to make sure that the data is well formed.  The header and
@@ -208,10 +778,184 @@ def extend_data(maude_data: MaudeData, new_data: MaudeData) -> MaudeData:
     return maude_data
 
 
+def merge_change_data(
+    maude_data: MaudeData, change_data: MaudeData, maude_keys: MaudeKeys, first: int, record_len: int
+) -> MaudeData:
+    """
+    Tacks the contents of the change files onto the records they belong to, starting from
+    the first column (the device records keep their report key column untouched).
+    """
+    for key in change_data.keys() & maude_keys:
+        for i in range(first, record_len):
+            byte_string = b"  Change: " + change_data[key][i]
+            maude_data[key][i] += byte_string
+    return maude_data
+
+
+def merge_patient_data(new_data: MaudeData, chunk_result: MaudeData, record_len: int) -> MaudeData:
+    """
+    An mdr key can show up in adjacent chunks of the patient problem files because each line
+    gets it's own problem code, so the chunks have to be merged by hand.
+    """
+    for k, v in chunk_result.items():
+        if k in new_data:
+            for x in range(1, record_len):
+                new_data[k][x] += b"  " + v[x]
+        else:
+            new_data[k] = v
+    return new_data
+
+
+class SpillStore:
+    """
+    Spill files for --max-memory.  Each chunk result is split up by report key into
+    n_partitions pieces which are pickled onto the end of that stage's partition files.
+    A partition can then be read back and joined without touching the rest of the data.
+    """
+
+    def __init__(self, parent: pathlib.Path, n_partitions: int) -> None:
+        self.directory = pathlib.Path(tempfile.mkdtemp(prefix="spill-", dir=parent))
+        self.n_partitions = n_partitions
+        self.record_lens: dict[str, int] = {}
+        self.runs: list[int] = []
+        self.stage = ""
+        self.files: list[BinaryIO] = []
+
+    def path(self, stage: str, partition: int) -> pathlib.Path:
+        return self.directory / f"{stage}-{partition}.pickle"
+
+    def write(self, stage: str, chunk_result: MaudeData) -> None:
+        if stage != self.stage:
+            self.close_files()
+            self.stage = stage
+            self.files = [open(self.path(stage, p), "ab") for p in range(self.n_partitions)]
+        partitions: list[MaudeData] = [{} for _ in range(self.n_partitions)]
+        for key, record in chunk_result.items():
+            partitions[key % self.n_partitions][key] = record
+        for f, partition in zip(self.files, partitions):
+            if partition:
+                pickle.dump(partition, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def read(self, stage: str, partition: int) -> Iterator:
+        self.close_files()
+        path = self.path(stage, partition)
+        if not path.exists():
+            return
+        with open(path, "rb", buffering=BUF_SIZE) as f:
+            while True:
+                try:
+                    yield pickle.load(f)
+                except EOFError:
+                    return
+
+    def write_run(self, partition: int, maude_data: MaudeData) -> None:
+        keys = sorted(maude_data)
+        with open(self.path("run", partition), "wb") as f:
+            for i in range(0, len(keys), RUN_BLOCK_SIZE):
+                records = [maude_data[key] for key in keys[i : i + RUN_BLOCK_SIZE]]
+                pickle.dump(records, f, protocol=pickle.HIGHEST_PROTOCOL)
+        self.runs.append(partition)
+
+    def read_run(self, partition: int) -> Iterator[list[bytes]]:
+        for records in self.read("run", partition):
+            yield from records
+
+    def close_files(self) -> None:
+        for f in self.files:
+            f.close()
+        self.files = []
+        self.stage = ""
+
+    def close(self) -> None:
+        self.close_files()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def join_partition(spill: SpillStore, partition: int) -> MaudeData:
+    """
+    Does the same merging that the parsing stages do in memory, but only for the report
+    keys in one partition of the spilled data.
+    """
+    maude_data: MaudeData = {}
+    for chunk_result in spill.read("device", partition):
+        maude_data.update(chunk_result)
+    maude_keys = set(maude_data.keys())
+    for chunk_result in spill.read("device-change", partition):
+        merge_change_data(maude_data, chunk_result, maude_keys, 1, spill.record_lens["device"])
+    for stage in ["foitext", "patient", "mdrfoi"]:
+        new_data: MaudeData = {}
+        record_len = spill.record_lens[stage]
+        for chunk_result in spill.read(stage, partition):
+            if stage == "patient":
+                merge_patient_data(new_data, chunk_result, record_len)
+            else:
+                new_data.update(chunk_result)
+        new_data = fill_blank_data(new_data, record_len, maude_keys - new_data.keys())
+        for chunk_result in spill.read(f"{stage}-change", partition):
+            merge_change_data(new_data, chunk_result, maude_keys, 0, record_len)
+        maude_data = extend_data(maude_data, new_data)
+    return maude_data
+
+
+def join_spilled_data(spill: SpillStore, header: Header) -> int:
+    """
+    Joins the spilled data one partition at a time and writes each partition back out sorted
+    by report key as a run, see write_spilled_data() for putting the runs together.
+    """
+    print("joining spilled data")
+    for partition in range(spill.n_partitions):
+        maude_data = join_partition(spill, partition)
+        if not maude_data:
+            continue
+        if err := length_check(maude_data, header):
+            return err
+        spill.write_run(partition, maude_data)
+    return SUCCESS
+
+
+def write_spilled_data(
+    file: pathlib.Path, spill: SpillStore, header: Header, compress: bool
+) -> tuple[int, int, SummaryData]:
+    """
+    The partitions are split up by report key hash, so the sorted runs are merged back together
+    to give the same output as write_maude_data_bytes().  The summary is counted on the way
+    through in the same order summarize_data() would see the reports.
+    """
+    print("writing output to disk")
+    problem_idx = header.index(b"PROBLEM_CODE")
+    n_reports = 0
+    n_problems = 0
+    summary_data = defaultdict(int)
+    sep = b"  "  # see summarize_data()
+    runs = [spill.read_run(partition) for partition in spill.runs]
+    with gzip.open(file, "wb", compresslevel=GZIP_LEVEL) if compress else open(file, "wb", buffering=BUF_SIZE) as f:
+        f.write(b"\t".join(header))
+        f.write(b"\n")
+        for record in heapq.merge(*runs, key=lambda record: int(record[0])):
+            f.write(b"\t".join(record))
+            f.write(b"\n")
+            n_reports += 1
+            for problem in record[problem_idx].split(sep):
+                summary_data[problem] += 1
+                n_problems += 1
+    return n_reports, n_problems, summary_data
+
+
+def count_chunks(file: pathlib.Path, chunking: Chunking) -> int:
+    """
+    Enough chunks to keep the whole pool busy and to keep each one under --chunk-size.  Worked out
+    per file so the little change files don't get split into hundreds of empty chunks.
+    """
+    min_chunks, chunk_size = chunking
+    if not chunk_size:
+        return min_chunks
+    return max(min_chunks, ceil(file.stat().st_size / chunk_size))
+
+
 def chunk_file(file: pathlib.Path, n_chunks: int) -> list[tuple[int, int]]:
     """
     Splits up a file based on the number of chunks requested (ditching the header)
-    The number of chunks will be the size of the multiprocessing pool.
+    The number of chunks usually comes from count_chunks().
     """
     file_size = file.stat().st_size
     chunk_size = file_size // n_chunks
@@ -232,6 +976,117 @@ def chunk_file(file: pathlib.Path, n_chunks: int) -> list[tuple[int, int]]:
     return file_locations
 
 
+def zone_map_chunk(file: pathlib.Path, start: int, end: int, prefetch: bool) -> tuple[int, int] | None:
+    """
+    Finds the smallest and largest report key between the specified start and end bytes
+    in the file.  Returns None if there aren't any report keys in the range.
+    """
+    lo: int | None = None
+    hi: int | None = None
+    pos: int = start
+    with open_chunk(file, start, end, prefetch) as f:
+        while pos < end:
+            line = f.readline()
+            pos += len(line)
+            bar_pos = line.find(b"|")
+            try:
+                key = int(line[:bar_pos])
+            except ValueError:
+                continue
+            if lo is None or key < lo:
+                lo = key
+            if hi is None or key > hi:
+                hi = key
+    if lo is None or hi is None:
+        return None
+    return lo, hi
+
+
+def get_zone_map(file: pathlib.Path, zone_dir: pathlib.Path, pool: PoolType, prefetch: bool) -> Zones:
+    """
+    Loads the min/max report key of each fixed size block of the file from its sidecar
+    in zone_dir, (re)building the sidecar if the file has changed since it was made.
+    """
+    stat = file.stat()
+    sidecar = zone_dir / f"{file.parent.name}-{file.name}.json"
+    try:
+        with open(sidecar, "rb") as f:
+            zone_map = json.load(f)
+        saved = (zone_map["size"], zone_map["mtime_ns"], zone_map["block_size"])
+        if saved == (stat.st_size, stat.st_mtime_ns, ZONE_BLOCK_SIZE):
+            return [tuple(zone) for zone in zone_map["zones"]]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    print(f"building zone map for: {file.name}")
+    locations = chunk_file(file, max(ceil(stat.st_size / ZONE_BLOCK_SIZE), 1))
+    tasks = []
+    for start, end in locations:
+        tasks.append([file, start, end, prefetch])
+    key_ranges = pool.starmap(zone_map_chunk, tasks)
+    zones = []
+    for (start, end), key_range in zip(locations, key_ranges):
+        if key_range:
+            zones.append((start, end, *key_range))
+    zone_map = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "block_size": ZONE_BLOCK_SIZE, "zones": zones}
+    zone_dir.mkdir(parents=True, exist_ok=True)
+    with open(sidecar, "w") as f:
+        json.dump(zone_map, f)
+    return zones
+
+
+def get_locations(
+    file: pathlib.Path,
+    n_chunks: int,
+    sorted_keys: list[int],
+    zone_dir: pathlib.Path | None,
+    pool: PoolType,
+    prefetch: bool,
+) -> list[tuple[int, int]]:
+    """
+    Without zone maps this is just chunk_file().  With zone maps the file is handed out in
+    blocks and any block whose report key range doesn't contain one of the keys being searched
+    for is dropped.  The foitext and mdrfoi files are split up by year and the report keys
+    roughly follow time, so narrow queries end up skipping most of the data.
+    """
+    if zone_dir is None:
+        return chunk_file(file, n_chunks)
+    zones = get_zone_map(file, zone_dir, pool, prefetch)
+    locations = []
+    for start, end, lo, hi in zones:
+        idx = bisect_left(sorted_keys, lo)
+        if idx < len(sorted_keys) and sorted_keys[idx] <= hi:
+            locations.append((start, end))
+    print(f"zone map: scanning {len(locations)} of {len(zones)} blocks in {file.name}")
+    return locations
+
+
+def get_projection(header: Header, columns: set[bytes]) -> Projection:
+    """
+    Figures out which columns of a file to keep.  The report key is always kept because
+    everything is joined on it and the problem code is always kept because the summary
+    is built from it.  Returns None when every column is being kept.
+    """
+    if not columns:
+        return None
+    projection = [i for i, name in enumerate(header) if not i or name in columns or name == b"PROBLEM_CODE"]
+    if len(projection) == len(header):
+        return None
+    return projection
+
+
+def check_columns(paths: list[pathlib.Path], columns: set[bytes]) -> set[bytes]:
+    """
+    Returns the requested columns that don't show up in the header of any of the data files.
+    """
+    known: set[bytes] = set()
+    for path in paths:
+        for file in path.iterdir():
+            if file.suffix == ".txt":
+                known.update(get_header(file))
+    return columns - known
+
+
 def get_header(file: pathlib.Path) -> Header:
     RN = -2
     with open(file, "rb") as f:
@@ -240,7 +1095,15 @@ def get_header(file: pathlib.Path) -> Header:
 
 
 def parse_device_files(
-    path: pathlib.Path, product_codes: set[bytes], n_chunks: int, pool: PoolType
+    path: pathlib.Path,
+    product_codes: set[bytes],
+    chunking: Chunking,
+    pool: PoolType,
+    engine: Engine,
+    columns: set[bytes],
+    prefetch: bool,
+    results: ResultFormat,
+    spill: SpillStore | None,
 ) -> tuple[MaudeData, Header, MaudeKeys]:
     """
     Searches through a folder and parses out data from device files for the product codes indicated.
@@ -250,7 +1113,10 @@ def parse_device_files(
     change_file = None
     header: Header = []
     line_len: int = -1
+    record_len: int = -1
+    projection: Projection = None
     maude_data: MaudeData = {}
+    maude_keys: MaudeKeys = set()
     fast_codes: bool = False
     if len(product_codes) < 3:
         fast_codes = True
@@ -266,46 +1132,70 @@ def parse_device_files(
             if not header:
                 header = get_header(file)
                 line_len = len(header)
-            locations = chunk_file(file, n_chunks)
+                projection = get_projection(header, columns)
+                if projection:
+                    header = [header[i] for i in projection]
+                record_len = len(header)
+            locations = chunk_file(file, count_chunks(file, chunking))
             tasks = []
             for start, end in locations:
-                tasks.append([file, start, end, product_codes, fast_codes, line_len])
+                tasks.append([file, start, end, product_codes, fast_codes, line_len, projection, prefetch])
             chunk_results = pool.starmap(parse_device_chunk, tasks)
             for chunk_result in chunk_results:
-                maude_data.update(chunk_result)
+                if spill:
+                    spill.write("device", chunk_result)
+                    maude_keys.update(chunk_result)
+                else:
+                    maude_data.update(chunk_result)
 
-    maude_keys = set(maude_data.keys())
+    if spill:
+        spill.record_lens["device"] = record_len
+    else:
+        maude_keys = set(maude_data.keys())
     if change_file:
         print(f"reading device file: {change_file.name}")
-        locations = chunk_file(change_file, n_chunks)
+        locations = chunk_file(change_file, count_chunks(change_file, chunking))
         tasks = []
         for start, end in locations:
-            tasks.append([change_file, start, end, maude_keys, line_len])
-        chunk_results = pool.starmap(parse_general_chunk, tasks)
+            tasks.append([change_file, start, end, maude_keys, line_len, projection, prefetch])
+        chunk_results = starmap_general_chunks(pool, tasks, engine, results)
         for chunk_result in chunk_results:
-            for key in chunk_result.keys() & maude_keys:
-                for i in range(1, line_len):
-                    byte_string = b"  Change: " + chunk_result[key][i]
-                    maude_data[key][i] += byte_string
+            if spill:
+                spill.write("device-change", chunk_result)
+            else:
+                merge_change_data(maude_data, chunk_result, maude_keys, 1, record_len)
 
     return maude_data, header, maude_keys
 
 
 def parse_device_chunk(
-    file: pathlib.Path, start: int, end: int, product_codes: set[bytes], fast_codes: bool, line_len: int
+    file: pathlib.Path,
+    start: int,
+    end: int,
+    product_codes: set[bytes],
+    fast_codes: bool,
+    line_len: int,
+    projection: Projection,
+    prefetch: bool,
 ) -> MaudeData:
     """
     Helper for parsing the device data across multiple processes.
     """
     if fast_codes:
-        maude_data = parse_device_chunk_fast_codes(file, start, end, product_codes, line_len)
+        maude_data = parse_device_chunk_fast_codes(file, start, end, product_codes, line_len, projection, prefetch)
     else:
-        maude_data = parse_device_chunk_reg_codes(file, start, end, product_codes, line_len)
+        maude_data = parse_device_chunk_reg_codes(file, start, end, product_codes, line_len, projection, prefetch)
     return maude_data
 
 
 def parse_device_chunk_fast_codes(
-    file: pathlib.Path, start: int, end: int, product_codes: set[bytes], line_len: int
+    file: pathlib.Path,
+    start: int,
+    end: int,
+    product_codes: set[bytes],
+    line_len: int,
+    projection: Projection,
+    prefetch: bool,
 ) -> MaudeData:
     """
     Fast parsing of device data looking for product codes in the line.
@@ -315,8 +1205,7 @@ def parse_device_chunk_fast_codes(
     REPORT_KEY = 0
     maude_data: MaudeData = {}
     pos: int = start
-    with open(file, "rb", buffering=BUF_SIZE) as f:
-        f.seek(start)
+    with open_chunk(file, start, end, prefetch) as f:
         while pos < end:
             line = f.readline()
             pos += len(line)
@@ -327,6 +1216,8 @@ def parse_device_chunk_fast_codes(
                         continue  # ditch malformed lines.
                     try:
                         key = int(split_line[REPORT_KEY])
+                        if projection:
+                            split_line = [split_line[i] for i in projection]
                         maude_data[key] = split_line
                     except ValueError:
                         # very seldom, the thing in the leftmost column isn't a number.
@@ -337,7 +1228,13 @@ def parse_device_chunk_fast_codes(
 
 
 def parse_device_chunk_reg_codes(
-    file: pathlib.Path, start: int, end: int, product_codes: set[bytes], line_len: int
+    file: pathlib.Path,
+    start: int,
+    end: int,
+    product_codes: set[bytes],
+    line_len: int,
+    projection: Projection,
+    prefetch: bool,
 ) -> MaudeData:
     """
     Normal parsing of device data looking for line's product code in the set of product codes.
@@ -348,8 +1245,7 @@ def parse_device_chunk_reg_codes(
     PRODUCT_CODE = 25
     maude_data: MaudeData = {}
     pos: int = start
-    with open(file, "rb", buffering=BUF_SIZE) as f:
-        f.seek(start)
+    with open_chunk(file, start, end, prefetch) as f:
         while pos < end:
             line = f.readline()
             pos += len(line)
@@ -359,6 +1255,8 @@ def parse_device_chunk_reg_codes(
             if split_line[PRODUCT_CODE] in product_codes:
                 try:
                     key = int(split_line[REPORT_KEY])
+                    if projection:
+                        split_line = [split_line[i] for i in projection]
                     maude_data[key] = split_line
                 except ValueError:
                     # TODO: add errors
@@ -367,7 +1265,9 @@ def parse_device_chunk_reg_codes(
     return maude_data
 
 
-def parse_general_chunk(file: pathlib.Path, start: int, end: int, keys: MaudeKeys, line_len: int) -> MaudeData:
+def parse_general_chunk(
+    file: pathlib.Path, start: int, end: int, keys: MaudeKeys, line_len: int, projection: Projection, prefetch: bool
+) -> MaudeData:
     """
     File parsing based on the specified start and end bytes in the file.
     """
@@ -375,8 +1275,7 @@ def parse_general_chunk(file: pathlib.Path, start: int, end: int, keys: MaudeKey
     maude_data: MaudeData = {}
     these_keys: MaudeKeys = set()
     pos: int = start
-    with open(file, "rb", buffering=BUF_SIZE) as f:
-        f.seek(start)
+    with open_chunk(file, start, end, prefetch) as f:
         while pos < end:
             line = f.readline()
             pos += len(line)
@@ -389,8 +1288,10 @@ def parse_general_chunk(file: pathlib.Path, start: int, end: int, keys: MaudeKey
                 split_line = line[:RN].split(b"|")
                 if len(split_line) != line_len:
                     continue
+                if projection:
+                    split_line = [split_line[i] for i in projection]
                 if key in these_keys:
-                    for i in range(1, line_len):
+                    for i in range(1, len(split_line)):
                         byte_string = b"  Change: " + split_line[i]
                         maude_data[key][i] += byte_string
                 else:
@@ -399,8 +1300,358 @@ def parse_general_chunk(file: pathlib.Path, start: int, end: int, keys: MaudeKey
     return maude_data
 
 
+def get_general_chunk_parser(engine: Engine) -> Callable[..., MaudeData]:
+    if engine == Engine.NUMPY:
+        return parse_general_chunk_numpy
+    return parse_general_chunk
+
+
+def read_line_blocks(file: pathlib.Path, start: int, end: int, block_size: int, advise: bool) -> Iterator[bytes]:
+    """
+    Reads the chunk in large blocks that always end on a line boundary.  The lines
+    covered are the same ones the readline based parsers see for the chunk.
+
+    With advise the kernel is told the chunk is going to be read sequentially, the next
+    block is requested ahead of time, and blocks that have already been read are dropped
+    from the page cache so a cold run doesn't push everything else out of it.
+    """
+    # NOTE: chunk_file() hands back empty (or backwards) ranges when a chunk is smaller than a
+    #       line, and posix_fadvise() rejects a negative length.
+    if end <= start:
+        return
+    advise = advise and HAS_FADVISE
+    pos: int = start
+    with open(file, "rb") as f:
+        fd = f.fileno()
+        if advise:
+            os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, start, min(block_size, end - start), os.POSIX_FADV_WILLNEED)
+        f.seek(start)
+        while pos < end:
+            if advise and pos + block_size < end:
+                os.posix_fadvise(fd, pos + block_size, min(block_size, end - pos - block_size), os.POSIX_FADV_WILLNEED)
+            block = f.read(min(block_size, end - pos))
+            if not block:
+                break
+            if not block.endswith(b"\n"):
+                block += f.readline()
+            if advise:
+                os.posix_fadvise(fd, pos, len(block), os.POSIX_FADV_DONTNEED)
+            pos += len(block)
+            yield block
+
+
+class PrefetchReader:
+    """
+    Double buffered reader for a chunk of a file.  A background thread reads the next
+    block (see read_line_blocks()) while the current one is being parsed, so a worker
+    isn't stuck alternating between waiting on the disk and parsing.  Supports readline()
+    for the line based parsers and iterating over the blocks for the numpy parsers.
+    """
+
+    def __init__(self, file: pathlib.Path, start: int, end: int, block_size: int) -> None:
+        self._blocks: queue.Queue[bytes | BaseException | None] = queue.Queue(maxsize=2)
+        self._stop = threading.Event()
+        self._buf = io.BytesIO()
+        self._thread = threading.Thread(target=self._fill, args=(file, start, end, block_size), daemon=True)
+        self._thread.start()
+
+    def _fill(self, file: pathlib.Path, start: int, end: int, block_size: int) -> None:
+        try:
+            for block in read_line_blocks(file, start, end, block_size, True):
+                if self._stop.is_set():
+                    return
+                self._blocks.put(block)
+        except BaseException as e:
+            self._blocks.put(e)
+        else:
+            self._blocks.put(None)
+
+    def next_block(self) -> bytes:
+        """
+        Returns an empty block once the chunk has been read.
+        """
+        block = self._blocks.get()
+        if block is None:
+            self._blocks.put(None)  # keep returning empty blocks.
+            return b""
+        if isinstance(block, BaseException):
+            raise block
+        return block
+
+    def readline(self) -> bytes:
+        # NOTE: blocks always end on a newline so lines never straddle two blocks.
+        line = self._buf.readline()
+        if not line:
+            self._buf = io.BytesIO(self.next_block())
+            line = self._buf.readline()
+        return line
+
+    def __iter__(self) -> Iterator[bytes]:
+        while block := self.next_block():
+            yield block
+
+    def __enter__(self) -> PrefetchReader:
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        while self._thread.is_alive():
+            try:
+                self._blocks.get(timeout=0.1)  # unblock the reader thread if the queue is full.
+            except queue.Empty:
+                pass
+
+
+def open_chunk(file: pathlib.Path, start: int, end: int, prefetch: bool) -> BinaryIO | PrefetchReader:
+    """
+    Opens a file for reading the lines of a chunk, either as a plain buffered file
+    seeked to the start of the chunk or through a PrefetchReader.
+    """
+    if prefetch:
+        return PrefetchReader(file, start, end, BUF_SIZE)
+    f = open(file, "rb", buffering=BUF_SIZE)
+    f.seek(start)
+    return f
+
+
+def open_chunk_blocks(
+    file: pathlib.Path, start: int, end: int, prefetch: bool
+) -> PrefetchReader | contextlib.nullcontext[Iterator[bytes]]:
+    """
+    Same as open_chunk() but for reading the chunk in large blocks.
+    """
+    if prefetch:
+        return PrefetchReader(file, start, end, NP_BLOCK_SIZE)
+    return contextlib.nullcontext(read_line_blocks(file, start, end, NP_BLOCK_SIZE, False))
+
+
+def select_key_lines(block: bytes, keys: np.ndarray, dec: bool) -> list[bytes]:
+    """
+    Vectorized version of the `line.find(b"|")`, `int(...)`, `key in keys` dance done
+    for every line of a file.  Returns the lines whose report key is in keys along with
+    any line whose key couldn't be parsed with vector ops (blank lines, signs, spaces, etc.)
+    so that the caller can give those the same treatment the pure python parsers do.
+    """
+    NEWLINE = ord(b"\n")
+    PIPE = ord(b"|")
+    ZERO = ord(b"0")
+    MAX_DIGITS = 18  # anything longer can overflow an int64, let python deal with it.
+    buf = np.frombuffer(block, dtype=np.uint8)
+    ends = np.flatnonzero(buf == NEWLINE) + 1
+    if not len(ends) or ends[-1] != len(buf):
+        ends = np.append(ends, len(buf))
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1]
+
+    pipes = np.flatnonzero(buf == PIPE)
+    if not len(pipes):
+        return [block[s:e] for s, e in zip(starts.tolist(), ends.tolist())]
+    pipe_idx = np.minimum(np.searchsorted(pipes, starts), len(pipes) - 1)
+    first_pipe = pipes[pipe_idx]
+    key_len = first_pipe - starts
+    if dec:
+        key_len -= 2  # NOTE: ".0", see parse_patient_chunk_dec()
+    ok = (first_pipe >= starts) & (first_pipe < ends) & (key_len > 0) & (key_len <= MAX_DIGITS)
+
+    line_keys = np.zeros(len(starts), dtype=np.int64)
+    max_len = int(key_len[ok].max()) if ok.any() else 0
+    last = len(buf) - 1
+    for d in range(max_len):
+        in_key = ok & (d < key_len)
+        digit = buf[np.minimum(starts + d, last)].astype(np.int64) - ZERO
+        ok &= ~in_key | ((digit >= 0) & (digit <= 9))
+        line_keys = np.where(in_key, line_keys * 10 + digit, line_keys)
+
+    selected = np.flatnonzero((ok & np.isin(line_keys, keys)) | ~ok)
+    return [block[s:e] for s, e in zip(starts[selected].tolist(), ends[selected].tolist())]
+
+
+def parse_general_chunk_numpy(
+    file: pathlib.Path, start: int, end: int, keys: MaudeKeys, line_len: int, projection: Projection, prefetch: bool
+) -> MaudeData:
+    """
+    Same as parse_general_chunk() but the key extraction and membership test is done with numpy
+    so that only the matching lines are handled in python.
+    """
+    RN = -2
+    maude_data: MaudeData = {}
+    these_keys: MaudeKeys = set()
+    key_array = np.sort(np.fromiter(keys, dtype=np.int64, count=len(keys)))
+    with open_chunk_blocks(file, start, end, prefetch) as blocks:
+        for block in blocks:
+            for line in select_key_lines(block, key_array, False):
+                bar_pos = line.find(b"|")
+                try:
+                    key = int(line[:bar_pos])
+                except ValueError:
+                    continue
+                if key in keys:
+                    split_line = line[:RN].split(b"|")
+                    if len(split_line) != line_len:
+                        continue
+                    if projection:
+                        split_line = [split_line[i] for i in projection]
+                    if key in these_keys:
+                        for i in range(1, len(split_line)):
+                            byte_string = b"  Change: " + split_line[i]
+                            maude_data[key][i] += byte_string
+                    else:
+                        maude_data[key] = split_line
+                        these_keys.add(key)
+    return maude_data
+
+
+def starmap_general_chunks(
+    pool: PoolType, tasks: list[list], engine: Engine, results: ResultFormat
+) -> Iterator[MaudeData]:
+    """
+    Runs parse_general_chunk() tasks in the pool.  With the compact result formats the workers
+    only pick out the matching lines and send them back as one buffer, and the lines are split
+    up here instead.  Sending a handful of big objects back to the parent is a lot cheaper than
+    pickling and unpickling millions of little bytes objects.
+    """
+    if results == ResultFormat.OBJECTS:
+        yield from pool.starmap(get_general_chunk_parser(engine), tasks)
+        return
+    shared = results == ResultFormat.SHARED
+    compact_tasks = [task + [engine, shared] for task in tasks]
+    if isinstance(pool, BatchedPool):
+        batches = pool.starmap_batches(parse_general_chunk_compact, compact_tasks)
+    else:
+        batches = iter([pool.starmap(parse_general_chunk_compact, compact_tasks)])
+    task_iter = iter(tasks)
+    for batch in batches:
+        unread = deque(batch)
+        try:
+            while unread:
+                compact = unread.popleft()
+                _, _, _, _, line_len, projection, _ = next(task_iter)
+                yield decode_compact_chunk(compact, line_len, projection)
+        finally:
+            # NOTE: only decode_compact_chunk() unlinks the shared memory, so if this stops early
+            #       (an error, Ctrl-C) the rest would sit in /dev/shm until a reboot.
+            for buffer, _, _ in unread:
+                if isinstance(buffer, tuple):
+                    unlink_shared_memory(buffer[0])
+
+
+def unlink_shared_memory(name: str) -> None:
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+def parse_general_chunk_compact(
+    file: pathlib.Path,
+    start: int,
+    end: int,
+    keys: MaudeKeys,
+    line_len: int,
+    projection: Projection,
+    prefetch: bool,
+    engine: Engine,
+    shared: bool,
+) -> CompactData:
+    """
+    Finds the lines with a report key in keys between the specified start and end bytes in
+    the file and returns them untouched as a single buffer, along with the report key and
+    starting offset of each line.  See decode_compact_chunk() for turning this into MaudeData.
+    With shared the buffer is left in shared memory and only its name is returned.
+    """
+    lines: list[bytes] = []
+    line_keys = array("q")
+    if engine == Engine.NUMPY:
+        key_array = np.sort(np.fromiter(keys, dtype=np.int64, count=len(keys)))
+        with open_chunk_blocks(file, start, end, prefetch) as blocks:
+            for block in blocks:
+                for line in select_key_lines(block, key_array, False):
+                    try:
+                        key = int(line[: line.find(b"|")])
+                    except ValueError:
+                        continue
+                    if key in keys:
+                        lines.append(line)
+                        line_keys.append(key)
+    else:
+        pos: int = start
+        with open_chunk(file, start, end, prefetch) as f:
+            while pos < end:
+                line = f.readline()
+                pos += len(line)
+                bar_pos = line.find(b"|")
+                try:
+                    key = int(line[:bar_pos])
+                except ValueError:
+                    continue
+                if key in keys:
+                    lines.append(line)
+                    line_keys.append(key)
+
+    offsets = array("q", [0])
+    offsets.extend(accumulate(len(line) for line in lines))
+    buffer = b"".join(lines)
+    if not shared:
+        return buffer, line_keys, offsets
+    shm = shared_memory.SharedMemory(create=True, size=max(len(buffer), 1))
+    shm.buf[: len(buffer)] = buffer
+    # NOTE: the parent unlinks the segment after reading it.  Stop the resource tracker
+    #       from cleaning it up (and complaining about it) when this worker exits.
+    resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore[attr-defined]
+    shm.close()
+    return (shm.name, len(buffer)), line_keys, offsets
+
+
+def decode_compact_chunk(compact: CompactData, line_len: int, projection: Projection) -> MaudeData:
+    """
+    Turns the result of parse_general_chunk_compact() into the same MaudeData that
+    parse_general_chunk() would have returned.
+    """
+    RN = -2
+    buffer, line_keys, offsets = compact
+    if isinstance(buffer, tuple):
+        name, size = buffer
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            buffer = bytes(shm.buf[:size])
+        finally:
+            shm.close()
+            shm.unlink()
+    maude_data: MaudeData = {}
+    these_keys: MaudeKeys = set()
+    for n, key in enumerate(line_keys):
+        split_line = buffer[offsets[n] : offsets[n + 1]][:RN].split(b"|")
+        if len(split_line) != line_len:
+            continue
+        if projection:
+            split_line = [split_line[i] for i in projection]
+        if key in these_keys:
+            for j in range(1, len(split_line)):
+                byte_string = b"  Change: " + split_line[j]
+                maude_data[key][j] += byte_string
+        else:
+            maude_data[key] = split_line
+            these_keys.add(key)
+    return maude_data
+
+
 def parse_foitext(
-    path: pathlib.Path, maude_data: MaudeData, header: Header, maude_keys: MaudeKeys, n_chunks: int, pool: PoolType
+    path: pathlib.Path,
+    maude_data: MaudeData,
+    header: Header,
+    maude_keys: MaudeKeys,
+    chunking: Chunking,
+    pool: PoolType,
+    engine: Engine,
+    zone_dir: pathlib.Path | None,
+    columns: set[bytes],
+    prefetch: bool,
+    results: ResultFormat,
+    spill: SpillStore | None,
 ) -> tuple[MaudeData, Header]:
     """
     This parses out the foi text which includes all the narrative data (reporter and manufacturer lies)
@@ -411,6 +1662,9 @@ def parse_foitext(
     header_add: Header = []
     new_data: MaudeData = {}
     line_len: int = -1
+    record_len: int = -1
+    projection: Projection = None
+    sorted_keys = sorted(maude_keys) if zone_dir else []
     print("Searching for foi text files")
     for file in path.iterdir():
         if "change" in file.name.lower():
@@ -422,31 +1676,43 @@ def parse_foitext(
             if not header_add:
                 this_header = get_header(file)
                 line_len = len(this_header)
+                projection = get_projection(this_header, columns)
+                if projection:
+                    this_header = [this_header[i] for i in projection]
+                record_len = len(this_header)
                 header_add = this_header[1:]
-            locations = chunk_file(file, n_chunks)
+            locations = get_locations(file, count_chunks(file, chunking), sorted_keys, zone_dir, pool, prefetch)
             tasks = []
             for start, end in locations:
-                tasks.append([file, start, end, maude_keys, line_len])
-            chunk_results = pool.starmap(parse_general_chunk, tasks)
+                tasks.append([file, start, end, maude_keys, line_len, projection, prefetch])
+            chunk_results = starmap_general_chunks(pool, tasks, engine, results)
             for chunk_result in chunk_results:
-                new_data.update(chunk_result)
+                if spill:
+                    spill.write("foitext", chunk_result)
+                else:
+                    new_data.update(chunk_result)
 
     # fill missing information
-    keys_to_update = maude_keys - new_data.keys()
-    new_data = fill_blank_data(new_data, line_len, keys_to_update)
+    if spill:
+        spill.record_lens["foitext"] = record_len
+    else:
+        keys_to_update = maude_keys - new_data.keys()
+        new_data = fill_blank_data(new_data, record_len, keys_to_update)
 
     if change_file:
         print(f"reading foi text file: {change_file.name}")
-        locations = chunk_file(change_file, n_chunks)
+        locations = get_locations(
+            change_file, count_chunks(change_file, chunking), sorted_keys, zone_dir, pool, prefetch
+        )
         tasks = []
         for start, end in locations:
-            tasks.append([change_file, start, end, maude_keys, line_len])
-        chunk_results = pool.starmap(parse_general_chunk, tasks)
+            tasks.append([change_file, start, end, maude_keys, line_len, projection, prefetch])
+        chunk_results = starmap_general_chunks(pool, tasks, engine, results)
         for chunk_result in chunk_results:
-            for key in chunk_result.keys() & maude_keys:
-                for i in range(line_len):
-                    byte_string = b"  Change: " + chunk_result[key][i]
-                    new_data[key][i] += byte_string
+            if spill:
+                spill.write("foitext-change", chunk_result)
+            else:
+                merge_change_data(new_data, chunk_result, maude_keys, 0, record_len)
 
     maude_data = extend_data(maude_data, new_data)
     header.extend(header_add)
@@ -494,8 +1760,12 @@ def parse_patient_problems(
     header: Header,
     maude_keys: MaudeKeys,
     patient_codes: PatientCodes,
-    n_chunks: int,
+    chunking: Chunking,
     pool: PoolType,
+    engine: Engine,
+    columns: set[bytes],
+    prefetch: bool,
+    spill: SpillStore | None,
 ) -> tuple[MaudeData, Header]:
     """
     This parses the patient problems (outcomes) for the maude data.  Patient outcomes
@@ -504,6 +1774,8 @@ def parse_patient_problems(
     new_data: MaudeData = {}
     header_add: Header = []
     line_len: int = -1
+    record_len: int = -1
+    projection: Projection = None
     print("Searching for patient files")
     for file in path.iterdir():
         if "patient" not in file.name.lower():
@@ -513,32 +1785,47 @@ def parse_patient_problems(
             if not header_add:
                 this_header = get_header(file)
                 line_len = len(this_header)
+                projection = get_projection(this_header, columns)
+                if projection:
+                    this_header = [this_header[i] for i in projection]
+                record_len = len(this_header)
                 header_add = this_header[1:]
-            locations = chunk_file(file, n_chunks)
+            locations = chunk_file(file, count_chunks(file, chunking))
             tasks = []
             fmt = get_patient_problem_format(file)
             for start, end in locations:
-                tasks.append([file, start, end, maude_keys, line_len, patient_codes, fmt])
-            chunk_results = pool.starmap(parse_patient_chunk, tasks)
+                tasks.append([file, start, end, maude_keys, line_len, patient_codes, fmt, projection, prefetch])
+            chunk_parser = parse_patient_chunk_numpy if engine == Engine.NUMPY else parse_patient_chunk
+            chunk_results = pool.starmap(chunk_parser, tasks)
             for chunk_result in chunk_results:
-                # we need to manually merge here because an mdr key can show up in adjacent
-                # chunks due to each line getting it's own problem code
-                for k, v in chunk_result.items():
-                    if k in new_data:
-                        for x in range(1, line_len):
-                            new_data[k][x] += b"  " + v[x]
-                    else:
-                        new_data[k] = v
+                if spill:
+                    spill.write("patient", chunk_result)
+                else:
+                    merge_patient_data(new_data, chunk_result, record_len)
     # fill in the blanks
-    keys_to_update = maude_keys - new_data.keys()
-    new_data = fill_blank_data(new_data, line_len, keys_to_update)
+    if spill:
+        spill.record_lens["patient"] = record_len
+    else:
+        keys_to_update = maude_keys - new_data.keys()
+        new_data = fill_blank_data(new_data, record_len, keys_to_update)
     header.extend(header_add)
     maude_data = extend_data(maude_data, new_data)
     return maude_data, header
 
 
 def parse_mdrfoi(
-    path: pathlib.Path, maude_data: MaudeData, header: Header, maude_keys: MaudeKeys, n_chunks: int, pool: PoolType
+    path: pathlib.Path,
+    maude_data: MaudeData,
+    header: Header,
+    maude_keys: MaudeKeys,
+    chunking: Chunking,
+    pool: PoolType,
+    engine: Engine,
+    zone_dir: pathlib.Path | None,
+    columns: set[bytes],
+    prefetch: bool,
+    results: ResultFormat,
+    spill: SpillStore | None,
 ) -> tuple[MaudeData, Header]:
     """
     This parses out the mrdfoi text.  The mdrfoi data has the EVENT_KEY which is the thing that is searchable
@@ -548,6 +1835,9 @@ def parse_mdrfoi(
     header_add: Header = []
     new_data: MaudeData = {}
     line_len: int = -1
+    record_len: int = -1
+    projection: Projection = None
+    sorted_keys = sorted(maude_keys) if zone_dir else []
     print("Searching for mdrfoi text files")
     for file in path.iterdir():
         if "change" in file.name.lower():
@@ -559,31 +1849,43 @@ def parse_mdrfoi(
             if not header_add:
                 this_header = get_header(file)
                 line_len = len(this_header)
+                projection = get_projection(this_header, columns)
+                if projection:
+                    this_header = [this_header[i] for i in projection]
+                record_len = len(this_header)
                 header_add = this_header[1:]
-            locations = chunk_file(file, n_chunks)
+            locations = get_locations(file, count_chunks(file, chunking), sorted_keys, zone_dir, pool, prefetch)
             tasks = []
             for start, end in locations:
-                tasks.append([file, start, end, maude_keys, line_len])
-            chunk_results = pool.starmap(parse_general_chunk, tasks)
+                tasks.append([file, start, end, maude_keys, line_len, projection, prefetch])
+            chunk_results = starmap_general_chunks(pool, tasks, engine, results)
             for chunk_result in chunk_results:
-                new_data.update(chunk_result)
+                if spill:
+                    spill.write("mdrfoi", chunk_result)
+                else:
+                    new_data.update(chunk_result)
 
     # fill missing information
-    keys_to_update = maude_keys - new_data.keys()
-    new_data = fill_blank_data(new_data, line_len, keys_to_update)
+    if spill:
+        spill.record_lens["mdrfoi"] = record_len
+    else:
+        keys_to_update = maude_keys - new_data.keys()
+        new_data = fill_blank_data(new_data, record_len, keys_to_update)
 
     if change_file:
         print(f"reading mdrfoi change file: {change_file.name}")
-        locations = chunk_file(change_file, n_chunks)
+        locations = get_locations(
+            change_file, count_chunks(change_file, chunking), sorted_keys, zone_dir, pool, prefetch
+        )
         tasks = []
         for start, end in locations:
-            tasks.append([change_file, start, end, maude_keys, line_len])
-        chunk_results = pool.starmap(parse_general_chunk, tasks)
+            tasks.append([change_file, start, end, maude_keys, line_len, projection, prefetch])
+        chunk_results = starmap_general_chunks(pool, tasks, engine, results)
         for chunk_result in chunk_results:
-            for key in chunk_result.keys() & maude_keys:
-                for i in range(line_len):
-                    byte_string = b"  Change: " + chunk_result[key][i]
-                    new_data[key][i] += byte_string
+            if spill:
+                spill.write("mdrfoi-change", chunk_result)
+            else:
+                merge_change_data(new_data, chunk_result, maude_keys, 0, record_len)
 
     maude_data = extend_data(maude_data, new_data)
     header.extend(header_add)
@@ -613,18 +1915,27 @@ def parse_patient_chunk(
     line_len: int,
     patient_codes: PatientCodes,
     f_type: PtFileType,
+    projection: Projection,
+    prefetch: bool,
 ) -> MaudeData:
     """
     Helper function because of capricious changes to file formats.
     """
     if f_type == PtFileType.DEC:
-        return parse_patient_chunk_dec(file, start, end, keys, line_len, patient_codes)
+        return parse_patient_chunk_dec(file, start, end, keys, line_len, patient_codes, projection, prefetch)
     elif f_type == PtFileType.INT:
-        return parse_patient_chunk_int(file, start, end, keys, line_len, patient_codes)
+        return parse_patient_chunk_int(file, start, end, keys, line_len, patient_codes, projection, prefetch)
 
 
 def parse_patient_chunk_dec(
-    file: pathlib.Path, start: int, end: int, keys: MaudeKeys, line_len: int, patient_codes: PatientCodes
+    file: pathlib.Path,
+    start: int,
+    end: int,
+    keys: MaudeKeys,
+    line_len: int,
+    patient_codes: PatientCodes,
+    projection: Projection,
+    prefetch: bool,
 ) -> MaudeData:
     """
     The patientproblemcode.txt file is weird in a few ways.
@@ -642,8 +1953,7 @@ def parse_patient_chunk_dec(
     PROBLEM_CODE = 2
     new_data: MaudeData = {}
     pos: int = start
-    with open(file, "rb", buffering=BUF_SIZE) as f:
-        f.seek(start)
+    with open_chunk(file, start, end, prefetch) as f:
         while pos < end:
             line = f.readline()
             pos += len(line)
@@ -655,8 +1965,10 @@ def parse_patient_chunk_dec(
                 key = int(split_line[REPORT_KEY][SPACE:DOT_ZERO])
                 if key in keys:
                     split_line[PROBLEM_CODE] = patient_codes[split_line[PROBLEM_CODE]]
+                    if projection:
+                        split_line = [split_line[i] for i in projection]
                     if key in new_data:
-                        for x in range(1, line_len):
+                        for x in range(1, len(split_line)):
                             byte_string = b"  " + split_line[x]
                             new_data[key][x] += byte_string
                     else:
@@ -669,7 +1981,14 @@ def parse_patient_chunk_dec(
 
 
 def parse_patient_chunk_int(
-    file: pathlib.Path, start: int, end: int, keys: MaudeKeys, line_len: int, patient_codes: PatientCodes
+    file: pathlib.Path,
+    start: int,
+    end: int,
+    keys: MaudeKeys,
+    line_len: int,
+    patient_codes: PatientCodes,
+    projection: Projection,
+    prefetch: bool,
 ) -> MaudeData:
     """
     The patientproblemcode.txt file is weird in a few ways.
@@ -684,8 +2003,7 @@ def parse_patient_chunk_int(
     PROBLEM_CODE = 2
     new_data: MaudeData = {}
     pos: int = start
-    with open(file, "rb", buffering=BUF_SIZE) as f:
-        f.seek(start)
+    with open_chunk(file, start, end, prefetch) as f:
         while pos < end:
             line = f.readline()
             pos += len(line)
@@ -696,8 +2014,10 @@ def parse_patient_chunk_int(
                 key = int(split_line[REPORT_KEY])
                 if key in keys:
                     split_line[PROBLEM_CODE] = patient_codes[split_line[PROBLEM_CODE]]
+                    if projection:
+                        split_line = [split_line[i] for i in projection]
                     if key in new_data:
-                        for x in range(1, line_len):
+                        for x in range(1, len(split_line)):
                             byte_string = b"  " + split_line[x]
                             new_data[key][x] += byte_string
                     else:
@@ -708,6 +2028,55 @@ def parse_patient_chunk_int(
     return new_data
 
 
+def parse_patient_chunk_numpy(
+    file: pathlib.Path,
+    start: int,
+    end: int,
+    keys: MaudeKeys,
+    line_len: int,
+    patient_codes: PatientCodes,
+    f_type: PtFileType,
+    projection: Projection,
+    prefetch: bool,
+) -> MaudeData:
+    """
+    Same as parse_patient_chunk_int() and parse_patient_chunk_dec() but the report keys are
+    pulled out and checked with numpy so only the matching lines get split in python.
+    """
+    RN = -2
+    DOT_ZERO = -2
+    REPORT_KEY = 0
+    PROBLEM_CODE = 2
+    dec = f_type == PtFileType.DEC
+    new_data: MaudeData = {}
+    key_array = np.sort(np.fromiter(keys, dtype=np.int64, count=len(keys)))
+    with open_chunk_blocks(file, start, end, prefetch) as blocks:
+        for block in blocks:
+            for line in select_key_lines(block, key_array, dec):
+                split_line = line[:RN].split(b"|")
+                if len(split_line) != line_len:
+                    continue
+                try:
+                    if dec:
+                        key = int(split_line[REPORT_KEY][:DOT_ZERO])
+                    else:
+                        key = int(split_line[REPORT_KEY])
+                    if key in keys:
+                        split_line[PROBLEM_CODE] = patient_codes[split_line[PROBLEM_CODE]]
+                        if projection:
+                            split_line = [split_line[i] for i in projection]
+                        if key in new_data:
+                            for x in range(1, len(split_line)):
+                                byte_string = b"  " + split_line[x]
+                                new_data[key][x] += byte_string
+                        else:
+                            new_data[key] = split_line
+                except IndexError:
+                    # TODO: add some error logging.
+                    pass
+    return new_data
+
+
 def summarize_data(header: Header, maude_data: MaudeData) -> tuple[int, int, SummaryData]:
     """
     Counts the problems encountered in the analyzed dataset.
@@ -724,6 +2093,142 @@ def summarize_data(header: Header, maude_data: MaudeData) -> tuple[int, int, Sum
     return n_reports, n_problems, summary_data
 
 
+def estimate_data(
+    device_path: pathlib.Path,
+    patient_path: pathlib.Path,
+    product_codes: set[bytes],
+    patient_codes: PatientCodes,
+    fraction: float,
+    chunking: Chunking,
+    pool: PoolType,
+    engine: Engine,
+    prefetch: bool,
+) -> tuple[Estimate, Estimate, dict[bytes, Estimate], float]:
+    """
+    Quick preview of a query.  Only a random sample of line aligned blocks from each device
+    file is scanned.  The patient problems for the reports found in those blocks are looked up
+    and each block is summarized with summarize_data().  The block counts are then scaled up to
+    the whole file (stratified by file) with 95% confidence intervals.  Also returns the fraction
+    of the blocks that were actually sampled, which isn't quite the one asked for.
+    """
+    line_len: int = -1
+    fast_codes: bool = False
+    if len(product_codes) < 3:
+        fast_codes = True
+        product_codes = {b"|" + pc + b"|" for pc in product_codes}
+    print("Sampling device files")
+    blocks: list[tuple[int, int]] = []  # (file index, number of blocks in the file) for each sampled block
+    tasks = []
+    n_files = 0
+    total_blocks = 0
+    for file in device_path.iterdir():
+        if "change" in file.name.lower() or "DEVICE" not in file.name.upper():
+            continue
+        size = file.stat().st_size
+        if line_len < 0 and size:
+            line_len = len(get_header(file))
+        locations = chunk_file(file, max(ceil(size / SAMPLE_BLOCK_SIZE), 1))
+        n_sample = min(len(locations), max(ceil(fraction * len(locations)), 2))
+        print(f"sampling {n_sample} of {len(locations)} blocks from device file: {file.name}")
+        for start, end in random.sample(locations, n_sample):
+            tasks.append([file, start, end, product_codes, fast_codes, line_len, None, prefetch])
+            blocks.append((n_files, len(locations)))
+        n_files += 1
+        total_blocks += len(locations)
+    block_results = pool.starmap(parse_device_chunk, tasks)
+
+    sampled_keys = set().union(*[block_result.keys() for block_result in block_results])
+    patient_data: MaudeData = {key: [b""] for key in sampled_keys}
+    patient_header: Header = [b"MDR_REPORT_KEY"]
+    patient_data, patient_header = parse_patient_problems(
+        patient_path,
+        patient_data,
+        patient_header,
+        sampled_keys,
+        patient_codes,
+        chunking,
+        pool,
+        engine,
+        set(),
+        prefetch,
+        None,
+    )
+
+    strata: dict[int, tuple[int, list[tuple[int, int, SummaryData]]]] = {}
+    for (file_idx, n_blocks), block_result in zip(blocks, block_results):
+        block_data = {key: patient_data[key] for key in block_result}
+        summary = summarize_data(patient_header, block_data) if block_data else (0, 0, {})
+        strata.setdefault(file_idx, (n_blocks, []))[1].append(summary)
+
+    reports = estimate_total([(n, [summary[0] for summary in s]) for n, s in strata.values()])
+    problems = estimate_total([(n, [summary[1] for summary in s]) for n, s in strata.values()])
+    problem_names = set().union(*[summary[2].keys() for _, s in strata.values() for summary in s])
+    problem_estimates = {}
+    for problem in problem_names:
+        problem_estimates[problem] = estimate_total(
+            [(n, [summary[2].get(problem, 0) for summary in s]) for n, s in strata.values()]
+        )
+    sampled_fraction = len(blocks) / total_blocks if total_blocks else 0.0
+    return reports, problems, problem_estimates, sampled_fraction
+
+
+def estimate_total(strata: list[tuple[int, list[int]]]) -> Estimate:
+    """
+    Stratified estimate of a total from a simple random sample of blocks in each stratum.
+    Each stratum is the number of blocks it has and the values of the sampled blocks.
+    Returns the estimate and the half width of its 95% confidence interval.
+    """
+    Z_95 = 1.96
+    total = 0.0
+    variance = 0.0
+    for n_blocks, values in strata:
+        n = len(values)
+        if not n:
+            continue
+        mean = sum(values) / n
+        total += n_blocks * mean
+        if n > 1:
+            s2 = sum((value - mean) ** 2 for value in values) / (n - 1)
+            variance += n_blocks**2 * (1 - n / n_blocks) * s2 / n
+    return total, Z_95 * sqrt(variance)
+
+
+def print_estimate(
+    reports: Estimate,
+    problems: Estimate,
+    problem_estimates: dict[bytes, Estimate],
+    product_codes: set[bytes],
+    fraction: float,
+) -> None:
+    """
+    Prints the estimate to the terminal in the same layout as the summary.
+    """
+    LEFT_PAD = 50
+    RIGHT_PAD = 22
+    TOP_PROBLEMS = 10
+    s = []
+    s.append(f'{"MAUDE Database Estimate (95% confidence)"}')
+    s.append(f'{""}')
+    s.append(f'{"Software version":<{LEFT_PAD}}{__version__:>{RIGHT_PAD}}')
+    s.append(f'{"Sampled fraction of device files":<{LEFT_PAD}}{fraction:>{RIGHT_PAD}.2%}')
+    for x, code in enumerate(sorted(product_codes)):
+        if not x:
+            s.append(f'{"Product codes analyzed":<{LEFT_PAD}}{code.decode("utf-8"):>{RIGHT_PAD}}')
+        else:
+            s.append(f'{"":<{LEFT_PAD}}{code.decode("utf-8"):>{RIGHT_PAD}}')
+    s.append(f'{""}')
+    s.append(f'{"Number of reports":<{LEFT_PAD}}{f"{reports[0]:.0f} +/- {reports[1]:.0f}":>{RIGHT_PAD}}')
+    s.append(f'{"Reported problems":<{LEFT_PAD}}{f"{problems[0]:.0f} +/- {problems[1]:.0f}":>{RIGHT_PAD}}')
+    s.append(f'{""}')
+    top = sorted(problem_estimates, key=lambda x: problem_estimates[x][0], reverse=True)[:TOP_PROBLEMS]
+    for problem in top:
+        estimate, interval = problem_estimates[problem]
+        problem_string = problem.decode("utf-8")[:LEFT_PAD]
+        s.append(f'{problem_string:<{LEFT_PAD}}{f"{estimate:.0f} +/- {interval:.0f}":>{RIGHT_PAD}}')
+    for line in s:
+        print(line)
+
+
 def write_summary_data(
     file: pathlib.Path,
     n_reports: int,
@@ -770,6 +2275,226 @@ def write_summary_data(
             f.write(b"\n")
 
 
+def dataset_fingerprint(paths: list[pathlib.Path]) -> str:
+    """
+    Cheap stand in for hashing the contents of every data file.  If a file gets
+    replaced by a fresh download its size or modification time will change.
+    """
+    fingerprint = hashlib.sha256()
+    for path in paths:
+        for file in sorted(path.iterdir()):
+            if file.is_file():
+                stat = file.stat()
+                fingerprint.update(f"{path.name}/{file.name}|{stat.st_size}|{stat.st_mtime_ns}\n".encode("utf-8"))
+    return fingerprint.hexdigest()
+
+
+def get_cache_entry(
+    cache_dir: pathlib.Path, product_codes: set[bytes], options: dict, fingerprint: str
+) -> pathlib.Path:
+    """
+    Each query gets its own directory in the cache named after everything that
+    can change the output.
+    """
+    query = repr((sorted(product_codes), sorted(options.items()), fingerprint))
+    return cache_dir / hashlib.sha256(query.encode("utf-8")).hexdigest()
+
+
+def load_cached_result(entry: pathlib.Path, maude_file: pathlib.Path) -> tuple[int, int, SummaryData] | None:
+    """
+    Copies a cached maude file to the output location and hands back the summary.
+    Returns None if the query hasn't been cached.
+    """
+    try:
+        with open(entry / CACHE_SUMMARY, "rb") as f:
+            n_reports, n_problems, summary_data = pickle.load(f)
+        shutil.copyfile(entry / CACHE_DATA, maude_file)
+    except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+        return None
+    print(f"using cached result: {entry.name}")
+    # bump the modification time so the least recently used entries get evicted first.
+    os.utime(entry)
+    return n_reports, n_problems, summary_data
+
+
+def store_cached_result(
+    entry: pathlib.Path,
+    maude_file: pathlib.Path,
+    n_reports: int,
+    n_problems: int,
+    summary_data: SummaryData,
+    cache_size: float,
+) -> None:
+    """
+    Stashes the output of a query in the cache and evicts the least recently used
+    entries until the cache fits in cache_size (GB) again.
+    """
+    max_size = int(cache_size * GIGA)
+    if maude_file.stat().st_size > max_size:
+        print("result is larger than the cache, not caching")
+        return
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    # NOTE: build the entry off to the side so a killed run can't leave a half written entry.
+    staging = entry.with_name(f"{entry.name}.{os.getpid()}.tmp")
+    if staging.exists():
+        shutil.rmtree(staging)
+    staging.mkdir()
+    shutil.copyfile(maude_file, staging / CACHE_DATA)
+    with open(staging / CACHE_SUMMARY, "wb") as f:
+        pickle.dump((n_reports, n_problems, dict(summary_data)), f)
+    if entry.exists():
+        shutil.rmtree(entry)
+    staging.rename(entry)
+    evict_cache(entry.parent, max_size)
+
+
+def evict_cache(cache_dir: pathlib.Path, max_size: int) -> None:
+    """
+    Removes the least recently used cache entries until the cache is under max_size bytes.
+    """
+    entries = []
+    total_size = 0
+    for entry in cache_dir.iterdir():
+        # NOTE: skip entries another run is still staging, see store_cached_result().
+        if entry.is_dir() and entry.suffix != ".tmp":
+            size = sum(file.stat().st_size for file in entry.iterdir())
+            entries.append((entry.stat().st_mtime, size, entry))
+            total_size += size
+    for _, size, entry in sorted(entries):
+        if total_size <= max_size:
+            break
+        print(f"evicting cached result: {entry.name}")
+        shutil.rmtree(entry)
+        total_size -= size
+
+
+def physical_cores() -> int:
+    """
+    Counts the physical cores from the cpu topology in sysfs, which saves pulling in psutil
+    just for this.  Falls back to the logical core count anywhere sysfs isn't around.
+    """
+    cores = set()
+    for topology in pathlib.Path("/sys/devices/system/cpu").glob("cpu[0-9]*/topology"):
+        try:
+            package = (topology / "physical_package_id").read_text().strip()
+            core = (topology / "core_id").read_text().strip()
+        except OSError:
+            continue
+        cores.add((package, core))
+    return len(cores) or multiprocessing.cpu_count()
+
+
+def profile_name(backend: Backend, engine: Engine, results: ResultFormat) -> str:
+    return f"{backend.name.lower()}-{engine.name.lower()}-{results.name.lower()}"
+
+
+def load_profile(file: pathlib.Path, backend: Backend, engine: Engine, results: ResultFormat) -> dict:
+    """
+    Returns the settings --autotune saved for this machine with this backend, engine, and result
+    format, or nothing if that combination hasn't been tuned.  Profiles are keyed by hostname so
+    a checkout on a shared drive works across machines.
+    """
+    try:
+        with open(file, "r") as f:
+            return json.load(f).get(socket.gethostname(), {}).get(profile_name(backend, engine, results), {})
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+
+def sample_report_keys(file: pathlib.Path, size: int, fraction: float) -> MaudeKeys:
+    """
+    Picks a random fraction of the report keys in the first size bytes of the file.
+    """
+    rng = random.Random(0)
+    keys: MaudeKeys = set()
+    with open(file, "rb", buffering=BUF_SIZE) as f:
+        pos = len(f.readline())
+        while pos < size:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            try:
+                key = int(line[: line.find(b"|")])
+            except ValueError:
+                continue
+            if rng.random() < fraction:
+                keys.add(key)
+    return keys
+
+
+def autotune(
+    paths: list[pathlib.Path], backend: Backend, engine: Engine, results: ResultFormat, profile_file: pathlib.Path
+) -> int:
+    """
+    Times the report key join on the start of the biggest file in each data folder for a handful
+    of pool sizes and chunk sizes.  The chunks are the same size they would be in a real run and
+    a slice of the report keys is searched for, so lines get split and records make the trip back
+    from the pool like they normally would.  The fastest combination is saved as this machine's
+    profile for the backend, engine, and result format, which later runs use unless -p or
+    --chunk-size is given.
+    """
+    physical = physical_cores()
+    logical = multiprocessing.cpu_count()
+    pool_sizes = sorted({max(physical // 2, 1), physical, (physical + logical) // 2, logical})
+    files = []
+    for path in paths:
+        data_files = [file for file in path.iterdir() if file.suffix == ".txt"]
+        if data_files:
+            files.append(max(data_files, key=lambda file: file.stat().st_size))
+    if not files:
+        print("No data files to tune with.")
+        return FAILURE
+    print(f"physical cores: {physical}, logical cores: {logical}")
+    max_sample = max(AUTOTUNE_SAMPLE_SIZE, AUTOTUNE_WAVES * max(pool_sizes) * max(AUTOTUNE_CHUNK_SIZES))
+    keys = {}
+    for file in files:
+        print(f"AUTOTUNE: Adding\t{file.name}")
+        # NOTE: this also reads the samples once up front so the first timing isn't stuck with a cold cache.
+        keys[file] = sample_report_keys(file, max_sample, AUTOTUNE_KEY_FRACTION)
+
+    throughputs = {}
+    print(f"{'POOL SIZE':20}{'CHUNK SIZE (MB)':20}{'THROUGHPUT GB/s':20}")
+    for pool_size in pool_sizes:
+        pool = make_pool(backend, pool_size)
+        for chunk_size in AUTOTUNE_CHUNK_SIZES:
+            sample_size = max(AUTOTUNE_SAMPLE_SIZE, AUTOTUNE_WAVES * pool_size * chunk_size)
+            tasks = []
+            for file in files:
+                line_len = len(get_header(file))
+                for start, end in chunk_file(file, count_chunks(file, (pool_size, chunk_size))):
+                    if start < sample_size:
+                        tasks.append([file, start, end, keys[file], line_len, None, False])
+            n_bytes = sum(end - start for _, start, end, *_ in tasks)
+            start_time = time()
+            for _ in starmap_general_chunks(pool, tasks, engine, results):
+                pass
+            throughput = n_bytes / (time() - start_time) / GIGA
+            throughputs[(pool_size, chunk_size)] = throughput
+            print(f"{pool_size:<20}{chunk_size // MEGA:<20}{throughput:<20.3f}")
+        pool.close()
+
+    procs, chunk_size = max(throughputs, key=lambda setting: throughputs[setting])
+    try:
+        with open(profile_file, "r") as f:
+            profiles = json.load(f)
+    except (OSError, ValueError):
+        profiles = {}
+    hostname = socket.gethostname()
+    name = profile_name(backend, engine, results)
+    profiles.setdefault(hostname, {})[name] = {
+        "procs": procs,
+        "chunk_size": chunk_size,
+        "physical_cores": physical,
+        "logical_cores": logical,
+        "tuned": strftime("%Y%m%d%H%M%S"),
+    }
+    with open(profile_file, "w") as f:
+        json.dump(profiles, f, indent=2)
+    print(f"saved {name} profile for {hostname}: -p {procs} --chunk-size {chunk_size // MEGA}")
+    return SUCCESS
+
+
 def test_speed(paths: list[pathlib.Path]) -> tuple[int, float]:
     """
     Figure out how fast raw reads are of all the files to get an idea
@@ -816,12 +2541,176 @@ def parse_args(args: list[str]) -> argparse.Namespace:
     parser.add_argument(
         "-t", "--test", help="Tests speed against raw read", default=False, action="store_true", dest="test"
     )
-    parser.add_argument("-p", "--processes", default=multiprocessing.cpu_count(), type=int, dest="procs")
+    parser.add_argument(
+        "-p",
+        "--processes",
+        help="Pool size (default: the --autotune profile for this machine, otherwise the physical core count)",
+        default=None,
+        type=int,
+        dest="procs",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        help="Chunk size in MB for splitting up the data files (default: the --autotune profile or one per process)",
+        default=None,
+        type=float,
+        dest="chunk_size",
+    )
+    parser.add_argument(
+        "--autotune",
+        help="Benchmark pool and chunk sizes on the data files and save the fastest as this machine's profile",
+        default=False,
+        action="store_true",
+        dest="autotune",
+    )
+    parser.add_argument(
+        "-b",
+        "--backend",
+        help="Pool used for parsing. auto picks threads on free-threaded builds, processes otherwise",
+        choices=["auto", "processes", "threads"],
+        default="auto",
+        type=str,
+        dest="backend",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        help="Parsing engine for the report key joins. numpy requires numpy to be installed",
+        choices=["python", "numpy"],
+        default="python",
+        type=str,
+        dest="engine",
+    )
     parser.add_argument("-o", "--output", default=r"output", type=str, dest="output_dir")
+    parser.add_argument(
+        "--columns",
+        help="Only output these columns (the report key and problem code are always included)",
+        nargs="+",
+        default=[],
+        type=str,
+        dest="columns",
+    )
+    parser.add_argument(
+        "-z",
+        "--zone-maps",
+        help="Skip foitext and mdrfoi blocks that cannot contain the report keys (built on first use)",
+        default=False,
+        action="store_true",
+        dest="zone_maps",
+    )
+    parser.add_argument(
+        "--prefetch",
+        help="Read ahead on a background thread and manage the page cache, helps when the files aren't cached",
+        default=False,
+        action="store_true",
+        dest="prefetch",
+    )
+    parser.add_argument(
+        "--results",
+        help="How workers send back results. compact sends one buffer per chunk, shared passes it in shared memory",
+        choices=["objects", "compact", "shared"],
+        default="objects",
+        type=str,
+        dest="results",
+    )
+    parser.add_argument(
+        "--max-memory",
+        help="Memory budget in GB, spills the parsed data to disk and joins it a piece at a time to stay under it",
+        default=0.0,
+        type=float,
+        dest="max_memory",
+    )
+    parser.add_argument(
+        "--estimate",
+        help="Estimate the counts from a random sample of the device files (fraction to sample, default 0.02)",
+        nargs="?",
+        const=0.02,
+        default=0.0,
+        type=float,
+        dest="estimate",
+    )
+    parser.add_argument(
+        "-w",
+        "--parallel-write",
+        help="Turn the output into bytes in a thread pool (-b threads only, --compress always compresses in the pool)",
+        default=False,
+        action="store_true",
+        dest="parallel_write",
+    )
+    parser.add_argument(
+        "--compress",
+        help="Compress the output file (always uses the parallel writer)",
+        choices=["none", "gzip"],
+        default="none",
+        type=str,
+        dest="compress",
+    )
+    parser.add_argument(
+        "--cache-dir", help="Where query results are cached", default=r"cache", type=str, dest="cache_dir"
+    )
+    parser.add_argument(
+        "--cache-size",
+        help="Size limit of the result cache in GB, least recently used results are evicted first",
+        default=4.0,
+        type=float,
+        dest="cache_size",
+    )
+    parser.add_argument(
+        "--no-cache", help="Always run the full scan", default=False, action="store_true", dest="no_cache"
+    )
+    parser.add_argument(
+        "--coordinator",
+        help="Hand the chunk tasks to remote workers (mauder.py worker) connecting to HOST:PORT",
+        default="",
+        type=str,
+        dest="coordinator",
+    )
+    parser.add_argument(
+        "--authkey",
+        help=f"Shared secret for the coordinator and workers (default: ${AUTHKEY_ENV})",
+        default=os.environ.get(AUTHKEY_ENV, ""),
+        type=str,
+        dest="authkey",
+    )
     parser.add_argument("-v", "--version", action="version", version=f"Mauder {__version__}")
     return parser.parse_args(args)
 
 
+def parse_worker_args(args: list[str]) -> argparse.Namespace:
+    description = textwrap.dedent(f"""\
+    Example:
+        python mauder.py worker --connect coordinator-host:{DEFAULT_PORT} --authkey SECRET
+        This will run the parsing tasks handed out by a coordinator started with
+        python mauder.py -c OYC --coordinator 0.0.0.0:{DEFAULT_PORT} --authkey SECRET
+    """)
+    parser = argparse.ArgumentParser(
+        prog="mauder.py worker", formatter_class=argparse.RawDescriptionHelpFormatter, description=description
+    )
+    parser.add_argument("--connect", help="Coordinator HOST:PORT", required=True, type=str, dest="connect")
+    parser.add_argument(
+        "--authkey",
+        help=f"Shared secret for the coordinator and workers (default: ${AUTHKEY_ENV})",
+        default=os.environ.get(AUTHKEY_ENV, ""),
+        type=str,
+        dest="authkey",
+    )
+    parser.add_argument(
+        "-p",
+        "--processes",
+        help="Pool size (default: the physical core count)",
+        default=None,
+        type=int,
+        dest="procs",
+    )
+    parser.add_argument(
+        "--data-dir", help="This machine's copy of mdr-data-files", default=r"mdr-data-files", type=str, dest="data_dir"
+    )
+    parser.add_argument(
+        "--wait", help="Seconds to keep trying to reach the coordinator", default=60, type=float, dest="wait"
+    )
+    return parser.parse_args(args)
+
+
 def print_long_help():
     long_help = textwrap.dedent("""\
     This utility searches the mdr-data-files directory for all product codes
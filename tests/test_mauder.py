@@ -0,0 +1,390 @@
+"""
+Smoke tests that run mauder.py end to end against a tiny made up copy of the MAUDE files.
+"""
+
+from collections.abc import Callable
+import gzip
+import json
+import multiprocessing.pool
+import os
+import pathlib
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+import pytest
+
+HERE = pathlib.Path(__file__).parent
+MAUDER = HERE.parent / "mauder.py"
+
+
+def write_file(path: pathlib.Path, header: list[str], rows: list[list[str]]) -> None:
+    with open(path, "wb") as f:
+        f.write(("|".join(header) + "\r\n").encode())
+        for row in rows:
+            f.write(("|".join(row) + "\r\n").encode())
+
+
+def make_data(root: pathlib.Path) -> None:
+    rng = random.Random(1)
+    data_dir = root / "mdr-data-files"
+    for name in ["device", "foitext", "patientproblemcode", "patientproblemdata", "mdrfoi"]:
+        (data_dir / name).mkdir(parents=True)
+    codes = ["OYC", "LGZ", "QFG", "AAA", "BBB"]
+    keys = list(range(1000, 4000))
+    product_codes = {key: rng.choice(codes) for key in keys}
+
+    device_header = ["MDR_REPORT_KEY", "DEVICE_NAME", "DEVICE_REPORT_PRODUCT_CODE", "MODEL_NUMBER"]
+    for year, year_keys in [(2022, keys[:1500]), (2023, keys[1500:])]:
+        rows = [[str(key), f"device {key}", product_codes[key], f"M{key}"] for key in year_keys]
+        write_file(data_dir / "device" / f"DEVICE{year}.txt", device_header, rows)
+    rows = [[str(key), "changed", product_codes[key], "M"] for key in keys[::50]]
+    write_file(data_dir / "device" / "DEVICEChange.txt", device_header, rows)
+
+    foi_header = ["MDR_REPORT_KEY", "MDR_TEXT_KEY", "FOI_TEXT"]
+    rows = [[str(key), str(key * 3), f"narrative for {key} " * rng.randint(1, 5)] for key in keys if key % 7]
+    write_file(data_dir / "foitext" / "foitext2023.txt", foi_header, rows)
+    write_file(data_dir / "foitext" / "foitextChange.txt", foi_header, [[str(keys[10]), "1", "changed text"]])
+
+    problems = [(str(1000 + i), f"Problem {i}") for i in range(10)]
+    with open(data_dir / "patientproblemdata" / "patientproblemcodes.csv", "wb") as f:
+        f.write(b"PROBLEM_CODE,DESCRIPTION\r\n")
+        for code, problem in problems:
+            f.write(f'{code},"{problem}, with comma"\r\n'.encode())
+    patient_header = ["MDR_REPORT_KEY", "PATIENT_SEQUENCE_NO", "PROBLEM_CODE", "DATE_ADDED", "DATE_CHANGED"]
+    rows = []
+    for key in keys:
+        for _ in range(rng.choice([0, 1, 2])):
+            rows.append([str(key), "1", rng.choice(problems)[0], "2020", ""])
+    write_file(data_dir / "patientproblemcode" / "patientproblemcode.txt", patient_header, rows)
+
+    mdrfoi_header = ["MDR_REPORT_KEY", "EVENT_KEY", "REPORT_NUMBER"]
+    rows = [[str(key), str(key + 7), f"R{key}"] for key in keys]
+    write_file(data_dir / "mdrfoi" / "mdrfoiThru2023.txt", mdrfoi_header, rows)
+
+
+@pytest.fixture
+def workdir(tmp_path: pathlib.Path) -> pathlib.Path:
+    # NOTE: mauder.py looks for mdr-data-files next to itself.
+    shutil.copy(MAUDER, tmp_path / "mauder.py")
+    make_data(tmp_path)
+    return tmp_path
+
+
+def run(workdir: pathlib.Path, *args: str, cache: bool = False) -> subprocess.CompletedProcess:
+    command = [sys.executable, str(workdir / "mauder.py"), "-c", "OYC", "LGZ", "-p", "2"]
+    if not cache:
+        command.append("--no-cache")
+    return subprocess.run([*command, *args], cwd=workdir, capture_output=True, text=True, timeout=300)
+
+
+def read_output(output_dir: pathlib.Path) -> bytes:
+    (maude_file,) = [file for file in output_dir.iterdir() if not file.name.endswith("summary.txt")]
+    return maude_file.read_bytes()
+
+
+def read_summary(output_dir: pathlib.Path) -> list[str]:
+    (summary_file,) = output_dir.glob("*summary.txt")
+    return [line for line in summary_file.read_text().splitlines() if not line.startswith("Report time")]
+
+
+def test_run(workdir: pathlib.Path) -> None:
+    result = run(workdir, "-o", "out")
+    assert result.returncode == 0, result.stderr
+    lines = read_output(workdir / "out").splitlines()
+    assert len(lines) > 1
+    keys = [int(line.split(b"\t")[0]) for line in lines[1:]]
+    assert keys == sorted(keys)
+
+
+def test_estimate(workdir: pathlib.Path) -> None:
+    result = run(workdir, "--estimate", "0.3")
+    assert result.returncode == 0, result.stderr
+    assert "Traceback" not in result.stderr
+    # NOTE: the files are tiny, so the two block minimum ends up sampling all of them.
+    (sampled,) = [line for line in result.stdout.splitlines() if line.startswith("Sampled fraction")]
+    assert sampled.split()[-1] == "100.00%"
+    (workdir / "mdr-data-files" / "device" / "DEVICE2024.txt").touch()
+    empty_result = run(workdir, "--estimate", "0.3")
+    assert empty_result.returncode == 0, empty_result.stderr
+    totals = [line for line in result.stdout.splitlines() if line.startswith(("Number of", "Reported"))]
+    assert totals == [line for line in empty_result.stdout.splitlines() if line.startswith(("Number of", "Reported"))]
+
+
+def test_max_memory(workdir: pathlib.Path) -> None:
+    assert run(workdir, "-o", "memory").returncode == 0
+    result = run(workdir, "--max-memory", "0.0001", "-o", "spill")
+    assert result.returncode == 0, result.stderr
+    assert read_output(workdir / "spill") == read_output(workdir / "memory")
+    # NOTE: about a thousand report keys times three processes is more than the 100 KB budget.
+    assert "report keys alone" in result.stdout
+    result = run(workdir, "--max-memory", "0.0001", "-b", "threads", "-o", "threads")
+    assert result.returncode == 0, result.stderr
+    assert read_output(workdir / "threads") == read_output(workdir / "memory")
+    assert "report keys alone" not in result.stdout
+    assert not list((workdir / "spill").glob("spill-*"))
+
+
+def test_max_memory_cleans_up_after_errors(workdir: pathlib.Path) -> None:
+    # NOTE: without a PROBLEM_CODE column the summary blows up after everything has been spilled.
+    patient_file = workdir / "mdr-data-files" / "patientproblemcode" / "patientproblemcode.txt"
+    patient_file.write_bytes(patient_file.read_bytes().replace(b"PROBLEM_CODE", b"PROBLEM_CODES", 1))
+    result = run(workdir, "--max-memory", "0.0001", "-o", "spill")
+    assert result.returncode != 0
+    assert not list((workdir / "spill").glob("spill-*"))
+
+
+@pytest.mark.parametrize("args", [["-w", "-b", "processes"], ["-w", "-b", "threads"], ["--compress", "gzip"]])
+def test_parallel_write(workdir: pathlib.Path, args: list[str]) -> None:
+    assert run(workdir, "-o", "single").returncode == 0
+    result = run(workdir, *args, "-o", "parallel")
+    assert result.returncode == 0, result.stderr
+    assert ("-w only helps" in result.stdout) == ("processes" in args)
+    output = read_output(workdir / "parallel")
+    if "gzip" in args:
+        output = gzip.decompress(output)
+    assert output == read_output(workdir / "single")
+
+
+def import_mauder(workdir: pathlib.Path):
+    sys.path.insert(0, str(workdir))
+    try:
+        import mauder
+    finally:
+        sys.path.remove(str(workdir))
+    return mauder
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_worker(workdir: pathlib.Path, port: int) -> subprocess.Popen:
+    command = [sys.executable, str(workdir / "mauder.py"), "worker", "--connect", f"127.0.0.1:{port}"]
+    return subprocess.Popen([*command, "--authkey", "test-key", "-p", "1"], cwd=workdir, stdout=subprocess.DEVNULL)
+
+
+def wait_for(condition: Callable[[], bool], timeout: float = 60) -> None:
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.1)
+
+
+def test_worker_only_runs_remote_tasks(workdir: pathlib.Path) -> None:
+    mauder = import_mauder(workdir)
+    port = free_port()
+    pool = mauder.RemotePool(("127.0.0.1", port), b"test-key", workdir / "mdr-data-files")
+    # NOTE: skips the coordinator side check in RemotePool.starmap() on purpose.
+    task_id = pool.board.submit("get_header", [pathlib.PurePosixPath("device", "DEVICE2022.txt")])
+    worker = start_worker(workdir, port)
+    try:
+        with pytest.raises(RuntimeError, match="can't be run remotely"):
+            pool.board.collect([task_id])
+    finally:
+        pool.close()
+        worker.wait(timeout=60)
+
+
+def test_remote_matches_local(workdir: pathlib.Path) -> None:
+    assert run(workdir, "-o", "local").returncode == 0
+    port = free_port()
+    command = [sys.executable, "-u", str(workdir / "mauder.py"), "-c", "OYC", "LGZ", "-p", "6", "--no-cache"]
+    command += ["--coordinator", f"127.0.0.1:{port}", "--authkey", "test-key", "-o", "remote"]
+    pipes = {"stdout": subprocess.PIPE, "stderr": subprocess.PIPE, "text": True}
+    coordinator = subprocess.Popen(command, cwd=workdir, **pipes)
+    # NOTE: a worker that shows up before the coordinator is listening retries a second later,
+    #       and by then a run this small can be over.
+    for line in coordinator.stdout:
+        if "coordinator listening" in line:
+            break
+    workers = [start_worker(workdir, port) for _ in range(3)]
+    try:
+        _, stderr = coordinator.communicate(timeout=300)
+        assert coordinator.returncode == 0, stderr
+    finally:
+        coordinator.kill()
+        for worker in workers:
+            worker.wait(timeout=60)
+    assert read_output(workdir / "remote") == read_output(workdir / "local")
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGSTOP"), reason="needs SIGSTOP")
+def test_lost_worker_tasks_are_reassigned(
+    workdir: pathlib.Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture
+) -> None:
+    mauder = import_mauder(workdir)
+    monkeypatch.setattr(mauder, "HEARTBEAT_TIMEOUT", 2)
+    device_file = workdir / "mdr-data-files" / "device" / "DEVICE2022.txt"
+    line_len = len(mauder.get_header(device_file))
+    tasks = [
+        [device_file, start, end, {b"|OYC|"}, True, line_len, None, False]
+        for start, end in mauder.chunk_file(device_file, 4)
+    ]
+    port = free_port()
+    pool = mauder.RemotePool(("127.0.0.1", port), b"test-key", workdir / "mdr-data-files")
+    doomed = start_worker(workdir, port)
+    worker = None
+    try:
+        doomed_id = f"{socket.gethostname()}-{doomed.pid}"
+        wait_for(lambda: doomed_id in pool.board._seen)
+        # NOTE: stopped while it's waiting on a claim, so it gets handed a task it will never finish.
+        doomed.send_signal(signal.SIGSTOP)
+        task_ids = [
+            pool.board.submit("parse_device_chunk", [pool.relative_path(arg) for arg in task]) for task in tasks
+        ]
+        wait_for(lambda: doomed_id in pool.board._leases.values())
+        doomed.kill()
+        worker = start_worker(workdir, port)
+        # NOTE: collect() blocks for good if the tasks never get reassigned.
+        results = multiprocessing.pool.ThreadPool(1).apply_async(pool.board.collect, [task_ids]).get(timeout=60)
+        assert results == [mauder.parse_device_chunk(*task) for task in tasks]
+    finally:
+        pool.close()
+        doomed.kill()
+        doomed.wait(timeout=60)
+        if worker:
+            worker.wait(timeout=60)
+    assert f"lost worker {doomed_id}, reassigning 1 tasks" in capsys.readouterr().out
+
+
+def test_remote_needs_authkey(workdir: pathlib.Path) -> None:
+    env = {key: value for key, value in os.environ.items() if key != "MAUDER_AUTHKEY"}
+    command = [sys.executable, str(workdir / "mauder.py")]
+    coordinator = [*command, "-c", "OYC", "--no-cache", "--coordinator", "127.0.0.1:0"]
+    worker = [*command, "worker", "--connect", "127.0.0.1:1", "--wait", "0"]
+    for args in [coordinator, worker]:
+        result = subprocess.run(args, cwd=workdir, env=env, capture_output=True, text=True, timeout=60)
+        assert result.returncode != 0
+        assert "authkey" in result.stdout
+
+
+@pytest.mark.parametrize("engine", ["python", "numpy"])
+def test_prefetch_tiny_chunks(workdir: pathlib.Path, engine: str) -> None:
+    if engine == "numpy":
+        pytest.importorskip("numpy")
+    assert run(workdir, "-o", "plain").returncode == 0
+    result = run(workdir, "--prefetch", "-e", engine, "--chunk-size", "0.00003", "-o", "prefetch")
+    assert result.returncode == 0, result.stderr
+    assert read_output(workdir / "prefetch") == read_output(workdir / "plain")
+
+
+def test_autotune_profile(workdir: pathlib.Path) -> None:
+    command = [sys.executable, str(workdir / "mauder.py"), "--autotune", "-b", "processes"]
+    result = subprocess.run(command, cwd=workdir, capture_output=True, text=True, timeout=600)
+    assert result.returncode == 0, result.stderr
+    profiles = json.loads((workdir / "mauder-profile.json").read_text())
+    (profile,) = profiles.values()
+    assert list(profile) == ["processes-python-objects"]
+    assert profile["processes-python-objects"]["procs"] >= 1
+
+
+def test_profile_matches_settings(workdir: pathlib.Path) -> None:
+    procs = import_mauder(workdir).physical_cores() + 1
+    profile = {"procs": procs, "chunk_size": 0}
+    (workdir / "mauder-profile.json").write_text(
+        json.dumps({socket.gethostname(): {"processes-python-objects": profile}})
+    )
+    command = [sys.executable, str(workdir / "mauder.py"), "-c", "OYC", "--no-cache", "-t"]
+    for backend, used in [("processes", True), ("threads", False)]:
+        result = subprocess.run([*command, "-b", backend], cwd=workdir, capture_output=True, text=True, timeout=300)
+        assert result.returncode == 0, result.stderr
+        pool_size = [line.split()[-1] for line in result.stdout.splitlines() if "pool size" in line]
+        assert (pool_size == [str(procs)]) == used
+
+
+def test_cache(workdir: pathlib.Path) -> None:
+    first = run(workdir, "-o", "first", cache=True)
+    assert first.returncode == 0, first.stderr
+    assert "using cached result" not in first.stdout
+    second = run(workdir, "-o", "second", cache=True)
+    assert second.returncode == 0, second.stderr
+    assert "using cached result" in second.stdout
+    assert read_output(workdir / "second") == read_output(workdir / "first")
+    assert read_summary(workdir / "second") == read_summary(workdir / "first")
+    device_file = workdir / "mdr-data-files" / "device" / "DEVICE2023.txt"
+    stat = device_file.stat()
+    os.utime(device_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    third = run(workdir, "-o", "third", cache=True)
+    assert third.returncode == 0, third.stderr
+    assert "using cached result" not in third.stdout
+    assert read_output(workdir / "third") == read_output(workdir / "first")
+
+
+def test_cache_evicts_least_recently_used(workdir: pathlib.Path) -> None:
+    cache_dir = workdir / "cache"
+    assert run(workdir, "-o", "a", cache=True).returncode == 0
+    (entry_a,) = cache_dir.iterdir()
+    assert run(workdir, "-c", "QFG", "-o", "b", cache=True).returncode == 0
+    (entry_b,) = set(cache_dir.iterdir()) - {entry_a}
+    assert "using cached result" in run(workdir, "-o", "a-again", cache=True).stdout
+    assert run(workdir, "-c", "AAA", "-o", "c-probe").returncode == 0
+    # NOTE: room for a and c (plus a little for the summaries) but not b as well.
+    size_a = sum(file.stat().st_size for file in entry_a.iterdir())
+    size_b = sum(file.stat().st_size for file in entry_b.iterdir())
+    size_c = len(read_output(workdir / "c-probe"))
+    cache_size = size_a + size_c + 2048
+    assert cache_size < size_a + size_b + size_c
+    result = run(workdir, "-c", "AAA", "-o", "c", "--cache-size", str(cache_size / 1024**3), cache=True)
+    assert result.returncode == 0, result.stderr
+    assert f"evicting cached result: {entry_b.name}" in result.stdout
+    assert entry_a.exists() and not entry_b.exists()
+    assert len(list(cache_dir.iterdir())) == 2
+
+
+def test_evict_cache_skips_staging(workdir: pathlib.Path) -> None:
+    mauder = import_mauder(workdir)
+    cache_dir = workdir / "cache"
+    for name in ["old-entry", "new-entry.1234.tmp"]:
+        (cache_dir / name).mkdir(parents=True)
+        (cache_dir / name / mauder.CACHE_DATA).write_bytes(b"x" * 100)
+    mauder.evict_cache(cache_dir, 0)
+    assert sorted(entry.name for entry in cache_dir.iterdir()) == ["new-entry.1234.tmp"]
+
+
+def test_zone_map_empty_file(workdir: pathlib.Path) -> None:
+    mauder = import_mauder(workdir)
+    empty_file = workdir / "mdr-data-files" / "foitext" / "foitext2024.txt"
+    empty_file.touch()
+    pool = multiprocessing.pool.ThreadPool(1)
+    try:
+        assert mauder.get_zone_map(empty_file, workdir / "zonemaps", pool, False) == []
+    finally:
+        pool.close()
+
+
+def test_chunks_per_file(workdir: pathlib.Path) -> None:
+    mauder = import_mauder(workdir)
+    foitext_dir = workdir / "mdr-data-files" / "foitext"
+    big_file, change_file = foitext_dir / "foitext2023.txt", foitext_dir / "foitextChange.txt"
+    assert mauder.count_chunks(change_file, (2, 1000)) == 2
+    assert mauder.count_chunks(big_file, (2, 1000)) == -(-big_file.stat().st_size // 1000)
+    assert mauder.count_chunks(big_file, (2, 0)) == 2
+
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="needs /dev/shm")
+@pytest.mark.parametrize("batched", [False, True])
+def test_shared_results_cleaned_up_early(workdir: pathlib.Path, batched: bool) -> None:
+    mauder = import_mauder(workdir)
+    foitext_file = workdir / "mdr-data-files" / "foitext" / "foitext2023.txt"
+    line_len = len(mauder.get_header(foitext_file))
+    keys = set(range(1000, 4000))
+    tasks = [
+        [foitext_file, start, end, keys, line_len, None, False] for start, end in mauder.chunk_file(foitext_file, 6)
+    ]
+    pool = multiprocessing.pool.ThreadPool(2)
+    before = set(os.listdir("/dev/shm"))
+    try:
+        chunk_pool = mauder.BatchedPool(pool, 2) if batched else pool
+        results = mauder.starmap_general_chunks(chunk_pool, tasks, mauder.Engine.PYTHON, mauder.ResultFormat.SHARED)
+        assert next(results)
+        results.close()
+    finally:
+        pool.close()
+    assert set(os.listdir("/dev/shm")) - before == set()